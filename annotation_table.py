@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+########################################################################
+# File: annotation_table.py
+# Purpose: Precomputed guide RNA selections for every exon of a gene
+#          annotation (e.g. a GENCODE or RefSeq GTF), built once with
+#          build_annotation.py and read by guideRNAselection.py --annotation.
+#
+#  The table is a SQLite file keyed by (chromosome, exonStart, exonEnd),
+#  so each input exon is answered by one indexed lookup. It records the
+#  selection settings it was built with and the guide file (path, size,
+#  mtime and SHA-256 checksum) of every chromosome; a chromosome is only
+#  looked up when both still match, and exons that are not in the
+#  annotation are designed as usual.
+########################################################################
+
+import gzip
+import json
+import os
+import sqlite3
+
+from result_cache import fileChecksum
+
+
+def readGtfExons(path):
+    '''
+    Yields the (chromosome, exonStart, exonEnd) key of every exon feature of a GTF file
+    (plain or gzip compressed), with 'chr' added to chromosome names that lack it (1 -> chr1).
+    Coordinates are kept as written in the GTF (1-based, inclusive).
+    '''
+    with open(path, 'rb') as h:
+        compressed = h.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rt') if compressed else open(path)) as gtf:
+        for line in gtf:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t', 5)
+            if len(fields) < 5 or fields[2] != 'exon':
+                continue
+            chromosome = fields[0] if fields[0].startswith('chr') else 'chr' + fields[0]
+            yield chromosome, int(fields[3]), int(fields[4])
+
+
+class AnnotationTable :
+    '''
+    SQLite table of per-exon selections for the exons of an annotation.
+
+    methods:
+    usable(chrom, settings, guidePath) : tells whether the table's selections for chrom are valid for these settings and guide file.
+    lookup(exonKeys) : returns the stored selections of the exons in exonKeys.
+    store(chrom, guidePath, selections) : adds the selections of a chromosome and records its guide file.
+    setSettings(settings, source) : records the settings key and annotation file the table is built from.
+    '''
+
+    def __init__(self, path, create=False):
+        if not create and not os.path.exists(path):
+            raise OSError('no annotation table ' + path)
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS selections (
+                chromosome TEXT NOT NULL,
+                exonStart INTEGER NOT NULL,
+                exonEnd INTEGER NOT NULL,
+                selection TEXT NOT NULL,
+                PRIMARY KEY (chromosome, exonStart, exonEnd)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS chromosomes (
+                chromosome TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                checksum TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS info (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        self.verified = {}
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def info(self, name):
+        row = self.db.execute('SELECT value FROM info WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def setSettings(self, settings, source):
+        '''Starts a build for a settings key: selections built with other settings are dropped.'''
+        with self.db:
+            if self.info('settings') != settings:
+                self.db.execute('DELETE FROM selections')
+                self.db.execute('DELETE FROM chromosomes')
+            self.db.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)', [('settings', settings), ('source', source)])
+
+    def usable(self, chrom, settings, guidePath):
+        '''
+        Returns True when chrom was built with the settings key and the guide file at guidePath.
+        The guide file is only checksummed when its path, size or mtime differ from the recorded ones;
+        when the checksum matches, the new path, size and mtime are recorded.
+        '''
+        if chrom not in self.verified:
+            row = self.db.execute('SELECT path, size, mtime, checksum FROM chromosomes WHERE chromosome = ?', (chrom,)).fetchone()
+            usable = row is not None and self.info('settings') == settings and os.path.exists(guidePath)
+            if usable:
+                stat = os.stat(guidePath)
+                current = (os.path.abspath(guidePath), stat.st_size, stat.st_mtime_ns)
+                if current != tuple(row[:3]):
+                    usable = stat.st_size == row[1] and fileChecksum(guidePath) == row[3]
+                    if usable:
+                        # Same contents: remember the new path and mtime so the file is not checksummed again
+                        try:
+                            with self.db:
+                                self.db.execute('UPDATE chromosomes SET path = ?, size = ?, mtime = ? WHERE chromosome = ?', current + (chrom,))
+                        except sqlite3.OperationalError:
+                            pass
+            self.verified[chrom] = usable
+        return self.verified[chrom]
+
+    def lookup(self, exonKeys):
+        '''
+        Returns a dict mapping each (chromosome, exonStart, exonEnd) of exonKeys found in the table to its
+        selection (one guide tuple per selection list, or None where no guide was found).
+        '''
+        found = {}
+        for key in set(exonKeys):
+            row = self.db.execute('SELECT selection FROM selections WHERE chromosome = ? AND exonStart = ? AND exonEnd = ?', key).fetchone()
+            if row is not None:
+                found[key] = [tuple(guide) if guide is not None else None for guide in json.loads(row[0])]
+        return found
+
+    def store(self, chrom, guidePath, selections):
+        '''Replaces the selections of chrom with a dict of exon key -> selection designed against guidePath.'''
+        stat = os.stat(guidePath)
+        checksum = fileChecksum(guidePath)
+        with self.db:
+            self.db.execute('DELETE FROM selections WHERE chromosome = ?', (chrom,))
+            self.db.executemany('INSERT INTO selections VALUES (?, ?, ?, ?)',
+                                [key + (json.dumps(selection),) for key, selection in selections.items()])
+            self.db.execute('INSERT OR REPLACE INTO chromosomes VALUES (?, ?, ?, ?, ?)',
+                            (chrom, os.path.abspath(guidePath), stat.st_size, stat.st_mtime_ns, checksum))
+        self.verified.pop(chrom, None)
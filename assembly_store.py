@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+########################################################################
+# File: assembly_store.py
+# Purpose: Versioned guide store holding several genome assemblies and
+#          CRISPR track releases side by side.
+#
+#  Layout:  <root>/<assembly>/manifest.json
+#           <root>/<assembly>/<release>/chrN,crispr.txt (+ chrN.guides, chrN.blocks)
+#
+#  The manifest records the SHA-256 checksum of every chromosome file of
+#  every release, and which release is current. An update splits the new
+#  track into a staging directory and only rewrites the chromosomes whose
+#  checksum changed; unchanged chromosomes are hard-linked from the
+#  previous release (or left alone when updating a release in place),
+#  together with their binary stores.
+########################################################################
+
+import json
+import os
+import shutil
+
+from guide_store import GuideTable, blockStoreFileName, storeFileName, textFileName, writeBlockStore, writeStore
+from result_cache import fileChecksum
+
+DEFAULT_STORE_ROOT = 'guide_stores'
+
+
+def addGuideDirOptions(parser):
+    '''Adds the -d/--guide-dir and --assembly, --release and --store-root options to an argparse parser (read back with guideDirFromArgs).'''
+    parser.add_argument('-d', '--guide-dir', action='store', default='.', help='Directory with the chromosome guide files (default .)')
+    parser.add_argument('--assembly', action='store', help='Read guides from this assembly (e.g. hg38) of the versioned guide store\nwritten by parse_crispr.py --assembly')
+    parser.add_argument('--release', action='store', help='Track release of --assembly to use (default: the current release)')
+    parser.add_argument('--store-root', action='store', default=DEFAULT_STORE_ROOT, help='Root directory of the versioned guide store (default {})'.format(DEFAULT_STORE_ROOT))
+
+
+def guideDirFromArgs(parser, args):
+    '''Returns the directory with the guide files: the --assembly release if given, otherwise --guide-dir.'''
+    if not args.assembly:
+        return args.guide_dir
+    try:
+        return AssemblyStore(args.store_root).resolve(args.assembly, args.release)
+    except ValueError as err:
+        parser.error(str(err))
+
+
+class AssemblyStore :
+    '''
+    Guide files of several assemblies and releases under one root directory.
+
+    methods:
+    releaseDir(assembly, release) : returns the directory of one release.
+    stagingDir(assembly, release) : returns an empty directory to split a new track into.
+    manifest(assembly) : returns the manifest of an assembly.
+    resolve(assembly, release) : returns the directory of a release, by default the current one.
+    update(assembly, release, stagingDir, store, blocks) : installs a staged release, rewriting only changed chromosomes.
+    '''
+
+    def __init__(self, root=DEFAULT_STORE_ROOT):
+        self.root = root
+
+    def assemblyDir(self, assembly):
+        return os.path.join(self.root, assembly)
+
+    def releaseDir(self, assembly, release):
+        return os.path.join(self.root, assembly, release)
+
+    def stagingDir(self, assembly, release):
+        '''Returns a fresh staging directory on the same file system as the release, so files can be renamed into place.'''
+        path = os.path.join(self.root, assembly, '.staging-' + release)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def manifest(self, assembly):
+        path = os.path.join(self.assemblyDir(assembly), 'manifest.json')
+        if not os.path.exists(path):
+            return {'current': None, 'releases': {}}
+        with open(path) as f:
+            return json.load(f)
+
+    def writeManifest(self, assembly, manifest):
+        path = os.path.join(self.assemblyDir(assembly), 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def resolve(self, assembly, release=None):
+        '''
+        Returns the directory holding the guide files of an assembly release (the current release by default).
+        Raises ValueError for an assembly or release that is not in the store.
+        '''
+        manifest = self.manifest(assembly)
+        release = release or manifest['current']
+        if release is None or release not in manifest['releases']:
+            known = ', '.join(sorted(manifest['releases'])) or 'none'
+            raise ValueError('no {} release {} in {} (releases: {})'.format(assembly, release, self.root, known))
+        return self.releaseDir(assembly, release)
+
+    @staticmethod
+    def chromosomeFiles(chrom, directory):
+        '''Returns the text, binary store and block store paths of a chromosome.'''
+        return (textFileName(chrom, directory), storeFileName(chrom, directory), blockStoreFileName(chrom, directory))
+
+    def update(self, assembly, release, stagingDir, store=False, blocks=False, blockGuides=4096):
+        '''
+        Installs the chrN,crispr.txt files split into stagingDir as a release of assembly, and makes it current.
+        A chromosome whose checksum matches the release being updated keeps its files; one matching the 
+        current release is hard-linked from it (copied where links are not supported). Either way only 
+        requested stores that are missing are written. Only the other chromosomes are moved into place and, with store or blocks, converted 
+        to binary stores.
+        Returns the lists of changed and unchanged chromosomes.
+        '''
+        manifest = self.manifest(assembly)
+        target = self.releaseDir(assembly, release)
+        os.makedirs(target, exist_ok=True)
+        existing = manifest['releases'].get(release, {}).get('chromosomes', {})
+        previousRelease = manifest['current'] if manifest['current'] != release else None
+        previous = manifest['releases'].get(previousRelease, {}).get('chromosomes', {})
+
+        chromosomes = {}
+        changed = []
+        unchanged = []
+        stagedSuffix = ',crispr.txt'
+        for name in sorted(os.listdir(stagingDir)):
+            if not name.endswith(stagedSuffix):
+                continue
+            chrom = name[:-len(stagedSuffix)]
+            staged = os.path.join(stagingDir, name)
+            checksum = fileChecksum(staged)
+            chromosomes[chrom] = checksum
+            targetFiles = self.chromosomeFiles(chrom, target)
+
+            if existing.get(chrom) == checksum and os.path.exists(targetFiles[0]):
+                os.remove(staged)
+                self.writeStores(targetFiles, store and not os.path.exists(targetFiles[1]), blocks and not os.path.exists(targetFiles[2]), blockGuides)
+                unchanged.append(chrom)
+                continue
+
+            previousFiles = self.chromosomeFiles(chrom, self.releaseDir(assembly, previousRelease)) if previousRelease else None
+            if previous.get(chrom) == checksum and os.path.exists(previousFiles[0]):
+                for source, destination in zip(previousFiles, targetFiles):
+                    self.removeFile(destination)
+                    if os.path.exists(source):
+                        self.linkFile(source, destination)
+                os.remove(staged)
+                self.writeStores(targetFiles, store and not os.path.exists(targetFiles[1]), blocks and not os.path.exists(targetFiles[2]), blockGuides)
+                unchanged.append(chrom)
+                continue
+
+            for destination in targetFiles[1:]:
+                self.removeFile(destination)
+            os.replace(staged, targetFiles[0])
+            self.writeStores(targetFiles, store, blocks, blockGuides)
+            changed.append(chrom)
+
+        # Chromosomes no longer in the track are dropped from an updated release
+        for chrom in set(existing) - set(chromosomes):
+            for path in self.chromosomeFiles(chrom, target):
+                self.removeFile(path)
+        shutil.rmtree(stagingDir, ignore_errors=True)
+
+        manifest['releases'][release] = {'chromosomes': chromosomes}
+        manifest['current'] = release
+        self.writeManifest(assembly, manifest)
+        return changed, unchanged
+
+    @staticmethod
+    def writeStores(files, store, blocks, blockGuides=4096):
+        '''Converts the text file of a chromosome to a binary store and/or a block store.'''
+        if store or blocks:
+            table = GuideTable.fromText(files[0])
+            if store:
+                writeStore(files[1], table)
+            if blocks:
+                writeBlockStore(files[2], table, blockGuides)
+
+    @staticmethod
+    def removeFile(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def linkFile(source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
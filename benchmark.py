@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+########################################################################
+# File: benchmark.py
+# Purpose: Performance benchmarks for the guide RNA design pipeline.
+#
+#  suite     : generates a synthetic CRISPR track (the tab-separated 8-column
+#              crispr_parsed.bed read by parse_crispr.py) and a JuncBase-style
+#              exon list, then times each pipeline stage at several scales:
+#              CrisprReader.readcrispr, GuideRna.rangeLists, spliceSiteGuides,
+#              midExonGuides and the output stage. Results are appended to a
+#              JSON file so runs of different versions can be compared.
+#  intervals : stabbing queries on exon windows, comparing the interval
+#              index in exon_index.py against a linear scan over every
+#              window, on a synthetic dense alternative-splicing exon set.
+#
+#  Usage: python3 benchmark.py suite --scales 20000,100000 --exons 2000
+#         python3 benchmark.py intervals --exons 100000 --queries 500
+########################################################################
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from argparse import RawTextHelpFormatter
+
+from design_settings import DesignSettings
+from exon_index import IntervalIndex
+from guideRNAselection import ExonFile, GuideOutput, GuideRna
+from parse_crispr import CrisprReader
+
+
+class CommandLine() :
+    '''Implements a help option and the benchmark options.'''
+    def __init__(self) :
+        self.parser = argparse.ArgumentParser(description = "Runs performance benchmarks for guide RNA design.\n"
+                                                            "\n"
+                                                            "suite = times each pipeline stage on synthetic guides and exons at several scales\n"
+                                                            "intervals = stabbing queries on exon windows, interval index vs linear scan\n",
+                                              formatter_class=RawTextHelpFormatter,
+                                              add_help = True,
+                                              usage = 'benchmark.py suite --scales 20000,100000'
+                                                )
+
+        self.parser.add_argument('benchmark', choices=['suite', 'intervals'], help='Benchmark to run')
+        self.parser.add_argument('--exons', action='store', type=int, help='Number of synthetic exons (default 2000 for suite, 100000 for intervals)')
+        self.parser.add_argument('--scales', action='store', default='20000,100000', help='Comma-separated guides per chromosome for suite (default 20000,100000)')
+        self.parser.add_argument('--chromosomes', action='store', type=int, default=2, help='Number of synthetic chromosomes for suite (default 2)')
+        self.parser.add_argument('--isoforms', action='store', type=int, default=8, help='Exons per gene; higher is denser (default 8)')
+        self.parser.add_argument('--splice-sites', action='store', type=int, default=12, help='Distinct splice sites per gene; lower means more overlap (default 12)')
+        self.parser.add_argument('--queries', action='store', type=int, default=500, help='Number of cut sites to query for intervals (default 500)')
+        self.parser.add_argument('--seed', action='store', type=int, default=1, help='Random seed (default 1)')
+        self.parser.add_argument('-o', '--output', action='store', default='benchmark_results.json', help='JSON file the suite results are appended to (default benchmark_results.json)')
+
+        self.args = self.parser.parse_args()
+
+
+def syntheticGuides(guidesPerChrom, chromosomes, rng, spacing=10):
+    '''
+    Yields tab-separated crispr_parsed.bed lines (chrom, start, end, strand, sequence, MIT, Doench, extra),
+    guidesPerChrom per chromosome on chr1..chrN, spaced spacing nt apart on average.
+    '''
+    for chromNumber in range(1, chromosomes + 1):
+        guideStart = 10000
+        for i in range(guidesPerChrom):
+            guideStart += rng.randint(1, 2 * spacing - 1)
+            sequence = ''.join(rng.choice('ACGT') for base in range(20)) + 'NGG'
+            yield 'chr{}\t{}\t{}\t{}\t{}\t{}\t{}%\t{}\n'.format(chromNumber, guideStart, guideStart + 23, rng.choice('+-'), sequence,
+                                                               rng.randint(0, 100), rng.randint(0, 100), rng.randint(0, 5000))
+
+
+def syntheticExons(exonCount, chromosomes, chromLength, rng, isoformsPerGene=20, spliceSitesPerGene=12, geneLength=3000):
+    '''
+    Returns exonCount (chromosome, exonStart, exonEnd) tuples clustered into genes on chr1..chrN.
+    Each gene has isoformsPerGene alternative exons that start at one of spliceSitesPerGene shared 
+    splice sites and take one of a few shared lengths, so exons within a gene are nested, 
+    overlapping or duplicated as in JuncBase output.
+    Fewer splice sites per gene give more overlap; more isoforms per gene give denser genes.
+    '''
+    exons = []
+    while len(exons) < exonCount:
+        chromosome = 'chr{}'.format(rng.randint(1, chromosomes))
+        geneStart = rng.randint(10000, max(10000, chromLength - geneLength))
+        spliceSites = rng.sample(range(geneStart, geneStart + geneLength), max(1, spliceSitesPerGene))
+        lengths = rng.sample(range(50, 400), 3)
+        for i in range(min(isoformsPerGene, exonCount - len(exons))):
+            exonStart = rng.choice(spliceSites)
+            exons.append((chromosome, exonStart, exonStart + rng.choice(lengths)))
+    return exons
+
+
+def juncBaseLine(exon):
+    '''Returns an exon tuple as an Associated_Exon_Coordinates line, e.g. 1:1000-1100'''
+    chromosome, exonStart, exonEnd = exon
+    return '{}:{}-{}\n'.format(chromosome[3:], exonStart, exonEnd)
+
+
+def denseExons(exonCount, rng, isoformsPerGene=20, geneSpacing=20000, geneLength=15000):
+    '''Returns exonCount dense alternative-splicing exons in consecutive genes on chr1.'''
+    exons = []
+    geneStart = 10000
+    while len(exons) < exonCount:
+        spliceSites = sorted(rng.sample(range(geneStart, geneStart + geneLength), 12))
+        for i in range(min(isoformsPerGene, exonCount - len(exons))):
+            exonStart, exonEnd = sorted(rng.sample(spliceSites, 2))
+            exons.append(('chr1', exonStart, exonEnd))
+        geneStart += geneSpacing
+    return exons
+
+
+def gitVersion():
+    '''Returns the current git commit of the benchmarked code, or None outside a git checkout.'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchScale(guidesPerChrom, exonCount, chromosomes, isoformsPerGene, spliceSitesPerGene, rng):
+    '''
+    Generates one synthetic data set in the current directory and times every pipeline stage on it.
+    Returns a dict of stage name -> seconds plus counts describing the data set.
+    '''
+    timings = {}
+
+    bedLines = list(syntheticGuides(guidesPerChrom, chromosomes, rng))
+    startTime = time.perf_counter()
+    CrisprReader(bedLines, progress=None).readcrispr()
+    timings['readcrispr'] = time.perf_counter() - startTime
+
+    chromLength = 10000 + 10 * guidesPerChrom
+    exons = syntheticExons(exonCount, chromosomes, chromLength, rng, isoformsPerGene, spliceSitesPerGene)
+    with open('exons.txt', 'w') as f:
+        f.writelines(juncBaseLine(exon) for exon in exons)
+    with open('exons.txt') as f:
+        allExons = [ExonFile.parseLine(line) for line in f]
+
+    for stage in ('rangeLists', 'spliceSiteGuides', 'midExonGuides', 'output'):
+        timings[stage] = 0.0
+    candidates = 0
+    settings = DesignSettings()
+    allLists = [[] for name in settings.selectionNames()]
+
+    for chromNumber in range(1, chromosomes + 1):
+        newGuides = GuideRna(allExons, 'chr{},'.format(chromNumber), settings=settings)
+
+        startTime = time.perf_counter()
+        guidesInFivePrimeRange, guidesInThreePrimeRange, guidesInMidRange = newGuides.rangeLists()
+        timings['rangeLists'] += time.perf_counter() - startTime
+        candidates += len(guidesInFivePrimeRange) + len(guidesInThreePrimeRange) + len(guidesInMidRange)
+
+        startTime = time.perf_counter()
+        spliceSite = newGuides.spliceSiteGuides(guidesInFivePrimeRange, guidesInThreePrimeRange)
+        timings['spliceSiteGuides'] += time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        midExon = newGuides.midExonGuides(guidesInMidRange)
+        timings['midExonGuides'] += time.perf_counter() - startTime
+        newGuides.close()
+
+        for guides, selected in zip(allLists, spliceSite + (midExon,)):
+            guides.extend(selected)
+
+    startTime = time.perf_counter()
+    with GuideOutput('exons', settings) as output:
+        output.writeGuides(allLists)
+    timings['output'] = time.perf_counter() - startTime
+
+    return {'guidesPerChromosome': guidesPerChrom, 'chromosomes': chromosomes, 'exons': exonCount,
+            'isoformsPerGene': isoformsPerGene, 'spliceSitesPerGene': spliceSitesPerGene,
+            'candidates': candidates, 'seconds': timings}
+
+
+def benchSuite(scales, exonCount, chromosomes, isoformsPerGene, spliceSitesPerGene, seed, outputPath):
+    '''Runs benchScale for every scale in a scratch directory and appends the run to outputPath.'''
+    outputPath = os.path.abspath(outputPath)
+    run = {'version': gitVersion(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'seed': seed, 'scales': []}
+
+    startDir = os.getcwd()
+    for guidesPerChrom in scales:
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            try:
+                result = benchScale(guidesPerChrom, exonCount, chromosomes, isoformsPerGene, spliceSitesPerGene, rng)
+            finally:
+                os.chdir(startDir)
+        run['scales'].append(result)
+        print('{:,} guides x {} chromosomes, {:,} exons, {:,} candidates'.format(guidesPerChrom, chromosomes, exonCount, result['candidates']))
+        for stage, seconds in result['seconds'].items():
+            print('  {:<17}: {:.3f} s'.format(stage, seconds))
+
+    history = []
+    if os.path.exists(outputPath):
+        with open(outputPath) as f:
+            history = json.load(f)
+    history.append(run)
+    with open(outputPath, 'w') as f:
+        json.dump(history, f, indent=1)
+    print('Results appended to', outputPath)
+
+
+def benchIntervals(exonCount, queryCount, seed):
+    '''Times stabbing queries against the 5' splice site windows using the index and a linear scan.'''
+    rng = random.Random(seed)
+    exons = denseExons(exonCount, rng)
+    windows = [GuideRna.exonWindows(exonStart, exonEnd)[0] for chromosome, exonStart, exonEnd in exons]
+    span = max(high for low, high in windows)
+    cutsites = [rng.randrange(0, span) for i in range(queryCount)]
+
+    startTime = time.perf_counter()
+    index = IntervalIndex(windows)
+    buildTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    indexed = [index.stab(cutsite) for cutsite in cutsites]
+    indexTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    scanned = [[position for position, (low, high) in enumerate(windows) if low <= cutsite < high] for cutsite in cutsites]
+    scanTime = time.perf_counter() - startTime
+
+    if indexed != scanned:
+        raise AssertionError('interval index and linear scan disagree')
+
+    hits = sum(len(found) for found in indexed)
+    print('{:,} exons, {:,} queries, {:,} window hits'.format(exonCount, queryCount, hits))
+    print('index build   : {:.3f} s'.format(buildTime))
+    print('index queries : {:.3f} s ({:.1f} us/query)'.format(indexTime, 1e6 * indexTime / queryCount))
+    print('linear scan   : {:.3f} s ({:.1f} us/query)'.format(scanTime, 1e6 * scanTime / queryCount))
+    print('speedup       : {:.0f}x'.format(scanTime / max(indexTime, 1e-9)))
+
+
+def main(cL=None):
+    '''Runs the requested benchmark.'''
+    cL = CommandLine ()
+
+    if cL.args.benchmark == 'suite':
+        scales = [int(scale) for scale in cL.args.scales.split(',')]
+        benchSuite(scales, cL.args.exons or 2000, cL.args.chromosomes, cL.args.isoforms, cL.args.splice_sites, cL.args.seed, cL.args.output)
+    elif cL.args.benchmark == 'intervals':
+        benchIntervals(cL.args.exons or 100000, cL.args.queries, cL.args.seed)
+
+if __name__ == "__main__":
+    main();
+    raise SystemExit
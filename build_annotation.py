@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+########################################################################
+# File: build_annotation.py
+# executable:
+# Purpose: One-time design of guide RNAs for every exon of a gene annotation.
+#          Runs the selection of guideRNAselection.py over each unique exon
+#          of a GTF file (e.g. GENCODE or RefSeq) and stores the results in
+#          an indexed table (see annotation_table.py). guideRNAselection.py
+#          --annotation then answers annotated exons with a lookup and only
+#          designs exons that are not in the annotation.
+#
+#  Required to first use parse_crispr.py to parse a crispr file from the genome browser.
+#  Input file: a GTF file, plain or gzip compressed.
+#  Output file: annotation.sqlite (-o)
+########################################################################
+
+import argparse
+import os
+import sys
+from argparse import RawTextHelpFormatter
+
+from annotation_table import AnnotationTable, readGtfExons
+from assembly_store import addGuideDirOptions, guideDirFromArgs
+from design_settings import addSettingsOptions, settingsFromArgs
+from guide_store import guideFileName
+from guideRNAselection import CHROM_LIST, exonKey, exonSelections, runChromosomes
+from run_metrics import RunMetrics
+
+class CommandLine() :
+    '''Implements a help option, the GTF input and the guide file and settings options.'''
+    def __init__(self) :
+        self.parser = argparse.ArgumentParser(description = "Designs guide RNAs for every exon of a GTF annotation and stores them\n"
+                                                            "in a table read by guideRNAselection.py --annotation.\n"
+                                                            "\n"
+                                                            "Use the same guide files (-d or --assembly) and settings (--config, --flank, --tier)\n"
+                                                            "as the guideRNAselection.py runs the table is for; chromosomes whose guide file\n"
+                                                            "or settings differ are designed as usual by those runs.\n",
+                                              formatter_class=RawTextHelpFormatter,
+                                              add_help = True,
+                                              usage = 'build_annotation.py gencode.gtf.gz -o gencode.sqlite'
+                                                )
+
+        self.parser.add_argument('gtf', help='GTF annotation (plain or gzip compressed)')
+        self.parser.add_argument('-o', '--output', action='store', default='annotation.sqlite', help='Annotation table to write (default annotation.sqlite)')
+        self.parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help='Number of chromosomes to design in parallel worker processes (default 1)')
+        self.parser.add_argument('--prefetch', action='store', type=int, help='Chromosomes whose guides are loaded ahead with -j 1\n(default 1 with guide stores, 0 with text guide files; 0 to turn off)')
+        self.parser.add_argument('--progress', action='store_true', help='Show a live progress line for each stage on stderr')
+        addGuideDirOptions(self.parser)
+        addSettingsOptions(self.parser)
+
+        self.args = self.parser.parse_args()
+
+
+def main(cL=None):
+    '''
+    Reads the unique exons of the GTF, designs them chromosome by chromosome,
+    and stores each chromosome's selections (including exons without guides) as it finishes.
+    '''
+    cL = CommandLine ()
+
+    settings = settingsFromArgs(cL.parser, cL.args)
+    guideDir = guideDirFromArgs(cL.parser, cL.args)
+    count = len(settings.selectionNames())
+    metrics = RunMetrics(sys.stderr if cL.args.progress else None)
+
+    with metrics.stage('all', 'exon file read') as record:
+        exonsByChrom = {chrom: [] for chrom in CHROM_LIST}
+        for exon in dict.fromkeys(readGtfExons(cL.args.gtf)):
+            exons = exonsByChrom.get(exon[0] + ',')
+            if exons is not None:
+                exons.append('{},{},{}'.format(*exon))
+        record['candidates'] = sum(map(len, exonsByChrom.values()))
+
+    for chrom in CHROM_LIST:
+        if exonsByChrom[chrom] and not os.path.exists(guideFileName(chrom.rstrip(','), guideDir)):
+            print("No guide file for", chrom.rstrip(','), "- its exons are left out of the table")
+            exonsByChrom[chrom] = []
+
+    with AnnotationTable(cL.args.output, create=True) as table:
+        table.setSettings(settings.key(), os.path.abspath(cL.args.gtf))
+        for chrom, result in runChromosomes(exonsByChrom, cL.args.jobs, metrics, settings, guideDir, cL.args.prefetch):
+            selections = exonSelections(result)
+            keys = [exonKey(exon) for exon in exonsByChrom[chrom]]
+            table.store(chrom.rstrip(','), guideFileName(chrom.rstrip(','), guideDir), {key: selections.get(key, [None] * count) for key in keys})
+            print("Stored guide RNAs of", len(keys), "exons on", chrom.rstrip(','))
+
+    metrics.finish()
+    print("Annotation table written to", cL.args.output)
+
+if __name__ == "__main__":
+    main();
+    raise SystemExit
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+########################################################################
+# File: design_server.py
+# Purpose: Long-running guide RNA design service.
+#          Loads every chromosome's guides once at startup and answers
+#          design requests over localhost HTTP or a Unix socket, using the
+#          same selection logic as guideRNAselection.py.
+#
+#  Requests:  POST /design  with exon coordinates in the JuncBase format,
+#                           one per line (e.g. 1:1000-1100), or a JSON
+#                           object {"exons": ["1:1000-1100", ...]}
+#             GET  /health  returns the loaded chromosomes and guide counts
+#  Responses are JSON; each exon gets its nearest and score tier (by default
+#  green and yellow) 5' and 3' guides and its mid-exon guide (null where no
+#  guide was found), e.g. nearestFivePrime, greenThreePrime, midExon.
+#  Tiers and window flank come from --config, --flank and --tier (see design_settings.py).
+#
+#  Example:   curl --data-binary @exons.txt http://127.0.0.1:8765/design
+########################################################################
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+from argparse import RawTextHelpFormatter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from assembly_store import addGuideDirOptions, guideDirFromArgs
+from design_settings import DesignSettings, addSettingsOptions, settingsFromArgs
+from guide_store import loadGuideTable
+from guideRNAselection import CHROM_LIST, ExonFile, designChromosome, exonKey, exonSelections
+
+class CommandLine() :
+    '''Implements a help option, the server address options and the guide file and settings options.'''
+    def __init__(self) :
+        self.parser = argparse.ArgumentParser(description = "Serves guide RNA designs for exon coordinates over HTTP.\n"
+                                                            "Guides for every chromosome are loaded once at startup.\n"
+                                                            "\n"
+                                                            "POST /design with one exon per line (e.g. 1:1000-1100) or {\"exons\": [...]}\n"
+                                                            "GET /health for the loaded chromosomes\n",
+                                              formatter_class=RawTextHelpFormatter,
+                                              add_help = True,
+                                              usage = 'design_server.py --port 8765'
+                                                )
+
+        self.parser.add_argument('--host', action='store', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+        self.parser.add_argument('--port', action='store', type=int, default=8765, help='Port to listen on (default 8765)')
+        self.parser.add_argument('--socket', action='store', help='Listen on this Unix socket path instead of a TCP port')
+        addGuideDirOptions(self.parser)
+        addSettingsOptions(self.parser)
+
+        self.args = self.parser.parse_args()
+
+
+def guideRecord(guide):
+    '''Returns the JSON form of a selected guide tuple, or None.'''
+    if guide is None:
+        return None
+    return {'cutsite': guide[0], 'guide': guide[4], 'MIT': guide[5], 'Doench': guide[6]}
+
+
+class DesignService :
+    '''
+    Holds the loaded guide tables and runs designs against them.
+
+    methods:
+    design(exonLines) : returns one result dict per exon coordinate line.
+    health() : returns the loaded chromosomes and their guide counts.
+    '''
+
+    def __init__(self, guideDir='.', chromList=CHROM_LIST, settings=None):
+        self.settings = settings if settings is not None else DesignSettings()
+        self.tables = {}
+        for chrom in chromList:
+            try:
+                self.tables[chrom] = loadGuideTable(chrom.rstrip(','), guideDir)
+            except FileNotFoundError:
+                print('No guide file for', chrom.rstrip(','), file=sys.stderr)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+
+    def health(self):
+        return {'chromosomes': {chrom.rstrip(','): len(table) for chrom, table in self.tables.items()}}
+
+    def design(self, exonLines):
+        '''
+        Designs guides for exon coordinate lines in the JuncBase format.
+        Raises ValueError for a line that is not a valid exon coordinate.
+        '''
+        exonLines = [line.strip() for line in exonLines if line.strip()]
+        keys = [exonKey(ExonFile.parseLine(line)) for line in exonLines]
+        # Each exon is designed once, however many lines name it
+        allExons = ['{},{},{}'.format(*key) for key in dict.fromkeys(keys)]
+
+        selections = {}
+        for chrom, table in self.tables.items():
+            exons = [exon for exon in allExons if exon.startswith(chrom)]
+            if exons:
+                selections.update(exonSelections(designChromosome(exons, chrom, table, settings=self.settings)))
+
+        names = self.settings.selectionNames()
+        results = []
+        for line, key in zip(exonLines, keys):
+            result = {'exon': line, 'chromosome': key[0], 'exonStart': key[1], 'exonEnd': key[2]}
+            for name, guide in zip(names, selections.get(key, [None] * len(names))):
+                result[name] = guideRecord(guide)
+            results.append(result)
+        return results
+
+
+class DesignRequestHandler(BaseHTTPRequestHandler) :
+    '''Handles /design and /health requests for the DesignService in server.service.'''
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def sendJson(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.sendJson(200, self.server.service.health())
+        else:
+            self.sendJson(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/design':
+            self.sendJson(404, {'error': 'unknown path ' + self.path})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        try:
+            if body.lstrip().startswith('{'):
+                exonLines = json.loads(body)['exons']
+            else:
+                exonLines = body.splitlines()
+            results = self.server.service.design(exonLines)
+        except (ValueError, KeyError, TypeError) as err:
+            self.sendJson(400, {'error': str(err)})
+            return
+        self.sendJson(200, {'exons': results})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer) :
+    '''HTTP server on a Unix socket, one thread per request.'''
+    daemon_threads = True
+
+
+def makeServer(service, host='127.0.0.1', port=8765, socketPath=None):
+    '''Returns an HTTP server for service, listening on a Unix socket if socketPath is given, otherwise on host:port.'''
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = ThreadingUnixHTTPServer(socketPath, DesignRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), DesignRequestHandler)
+    server.service = service
+    return server
+
+
+def main(cL=None):
+    '''Loads the guide tables once, then serves design requests until interrupted.'''
+    cL = CommandLine ()
+
+    settings = settingsFromArgs(cL.parser, cL.args)
+    guideDir = guideDirFromArgs(cL.parser, cL.args)
+    service = DesignService(guideDir, settings=settings)
+    server = makeServer(service, cL.args.host, cL.args.port, cL.args.socket)
+    print('Serving guide RNA designs on', cL.args.socket or '{}:{}'.format(cL.args.host, cL.args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main();
+    raise SystemExit
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+########################################################################
+# File: design_settings.py
+# Purpose: Window and score tier rules for guide RNA selection.
+#
+#  flank : how far (nt) the 5' and 3' splice site windows extend outside
+#          the exon.
+#  tiers : score tiers selected at each splice site in addition to the
+#          nearest guide. A guide is in a tier when MIT > minMIT and
+#          Doench > minDoench. The defaults are "green" (MIT>50, Doench>60)
+#          and "yellow" (MIT>50, Doench>30).
+#
+#  Settings come from a JSON config file, e.g.
+#          {"flank": 200, "tiers": [{"name": "green", "mit": 50, "doench": 60}]}
+#  and/or the --flank and --tier options (see addSettingsOptions), shared by
+#  guideRNAselection.py, build_annotation.py and design_server.py.
+########################################################################
+
+import json
+from collections import namedtuple
+
+
+class ScoreTier(namedtuple('ScoreTier', 'name minMIT minDoench')) :
+    '''A score tier: guides with MIT > minMIT and Doench > minDoench.'''
+
+    @classmethod
+    def parse(cls, text):
+        '''Parses a tier given as name:MIT:Doench, e.g. green:50:60'''
+        try:
+            name, minMIT, minDoench = text.split(':')
+            return cls(name, int(minMIT), int(minDoench))
+        except ValueError:
+            raise ValueError('score tier should be name:MIT:Doench, not ' + text)
+
+
+DEFAULT_TIERS = (ScoreTier('green', 50, 60), ScoreTier('yellow', 50, 30))
+
+
+class DesignSettings :
+    '''
+    Window size and score tiers used by GuideRna.
+
+    methods:
+    key() : returns a string identifying the settings, used in result cache keys.
+    tierNames() : returns the names of the splice site tiers, starting with 'nearest'.
+    selectionNames() : returns the names of all guide lists a design returns, in order.
+    fromConfig(path) : reads settings from a JSON config file.
+    '''
+
+    def __init__(self, flank=200, tiers=DEFAULT_TIERS):
+        self.flank = flank
+        self.tiers = tuple(tiers)
+        names = self.tierNames()
+        if len(set(names)) != len(names):
+            raise ValueError('score tier names must be unique and not "nearest"')
+
+    def key(self):
+        return 'flank={};'.format(self.flank) + ';'.join('{}=MIT>{},Doench>{}'.format(*tier) for tier in self.tiers)
+
+    def tierNames(self):
+        return ['nearest'] + [tier.name for tier in self.tiers]
+
+    def selectionNames(self):
+        '''e.g. nearestFivePrime, greenFivePrime, ..., nearestThreePrime, ..., midExon'''
+        return ([name + 'FivePrime' for name in self.tierNames()] +
+                [name + 'ThreePrime' for name in self.tierNames()] + ['midExon'])
+
+    @classmethod
+    def fromConfig(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        tiers = DEFAULT_TIERS
+        if 'tiers' in config:
+            tiers = [ScoreTier(tier['name'], int(tier['mit']), int(tier['doench'])) for tier in config['tiers']]
+        return cls(int(config.get('flank', 200)), tiers)
+
+
+def addSettingsOptions(parser):
+    '''Adds the --config, --flank and --tier options to an argparse parser (read back with settingsFromArgs).'''
+    parser.add_argument('--config', action='store', help='JSON file with the window flank and score tiers, e.g.\n{"flank": 200, "tiers": [{"name": "green", "mit": 50, "doench": 60}]}')
+    parser.add_argument('--flank', action='store', type=int, help='nt the 5\' and 3\' splice site windows extend outside the exon (default 200)')
+    parser.add_argument('--tier', action='append', type=ScoreTier.parse, metavar='NAME:MIT:DOENCH',
+                        help='Score tier with MIT > MIT and Doench > DOENCH; repeat for several tiers.\nReplaces the default tiers green:50:60 and yellow:50:30')
+
+
+def settingsFromArgs(parser, args):
+    '''Returns the DesignSettings given by --config, --flank and --tier; exits with a parser error for invalid settings.'''
+    try:
+        settings = DesignSettings.fromConfig(args.config) if args.config else DesignSettings()
+        return DesignSettings(args.flank if args.flank is not None else settings.flank, args.tier or settings.tiers)
+    except (OSError, KeyError, TypeError, ValueError) as err:
+        parser.error('invalid settings: ' + str(err))
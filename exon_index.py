@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+########################################################################
+# File: exon_index.py
+# Purpose: Static interval index over exon cutsite windows.
+#          Alternative splicing inputs contain many nested and overlapping
+#          exons, so the 5', 3' and mid-exon windows of one chromosome
+#          overlap heavily. The index answers "which windows contain this
+#          cut site" in O(log n + k) instead of scanning every window.
+#
+#  The index is an implicit augmented interval tree: intervals are sorted
+#  by start and laid out as the in-order traversal of a complete binary
+#  tree, with the maximum end of each subtree stored alongside.
+########################################################################
+
+
+class IntervalIndex :
+    '''
+    Index over half-open intervals [low, high).
+    Intervals are identified by their position in the input, and every query
+    returns those positions in ascending order.
+
+    methods:
+    stab(point) : returns every interval containing point.
+    overlapping(low, high) : returns every interval overlapping [low, high).
+    coveredRegions() : returns the union of all intervals as sorted, disjoint [low, high) pairs.
+    '''
+
+    def __init__(self, intervals):
+        intervals = sorted((low, high, position) for position, (low, high) in enumerate(intervals))
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.positions = [interval[2] for interval in intervals]
+        self.maxEnds = list(self.ends)
+        self.maxLevel = self._augment()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _augment(self):
+        '''Fills maxEnds bottom-up and returns the level of the root.'''
+        n = len(self.starts)
+        if n == 0:
+            return -1
+        ends = self.ends
+        maxEnds = self.maxEnds
+
+        lastIndex = (n - 1) & ~1
+        last = ends[lastIndex]
+        level = 1
+        while (1 << level) <= n:
+            half = 1 << (level - 1)
+            for i in range((half << 1) - 1, n, half << 2):
+                rightMax = maxEnds[i + half] if i + half < n else last
+                maxEnds[i] = max(ends[i], maxEnds[i - half], rightMax)
+            lastIndex = lastIndex - half if (lastIndex >> level) & 1 else lastIndex + half
+            if lastIndex < n and maxEnds[lastIndex] > last:
+                last = maxEnds[lastIndex]
+            level += 1
+        return level - 1
+
+    def overlapping(self, low, high):
+        '''Returns the input positions of all intervals overlapping [low, high), in ascending order.'''
+        n = len(self.starts)
+        if n == 0:
+            return []
+        starts, ends, maxEnds = self.starts, self.ends, self.maxEnds
+        found = []
+
+        stack = [(self.maxLevel, (1 << self.maxLevel) - 1, False)]
+        while stack:
+            level, i, visited = stack.pop()
+            if level <= 3:
+                # Small subtree: scan it directly
+                first = i >> level << level
+                for j in range(first, min(first + (1 << (level + 1)) - 1, n)):
+                    if starts[j] >= high:
+                        break
+                    if low < ends[j]:
+                        found.append(j)
+            elif not visited:
+                stack.append((level, i, True))
+                left = i - (1 << (level - 1))
+                if left >= n or maxEnds[left] > low:
+                    stack.append((level - 1, left, False))
+            elif i < n and starts[i] < high:
+                if low < ends[i]:
+                    found.append(i)
+                stack.append((level - 1, i + (1 << (level - 1)), False))
+
+        positions = self.positions
+        return sorted(positions[j] for j in found)
+
+    def stab(self, point):
+        '''Returns the input positions of all intervals containing point, in ascending order.'''
+        return self.overlapping(point, point + 1)
+
+    def coveredRegions(self):
+        '''Returns the union of all non-empty intervals as sorted, disjoint [low, high) pairs.'''
+        regions = []
+        for low, high in zip(self.starts, self.ends):
+            if high <= low:
+                continue
+            if regions and low <= regions[-1][1]:
+                if high > regions[-1][1]:
+                    regions[-1][1] = high
+            else:
+                regions.append([low, high])
+        return [tuple(region) for region in regions]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+########################################################################
+# File: exon_stream.py
+# Purpose: Bounded-memory exon bucketing for guideRNAselection.py --max-memory.
+#          Exons are read once from the input, bucketed by chromosome and
+#          sorted by (exonStart, exonEnd). When more exons are held than the
+#          memory budget allows, every bucket is sorted and spilled to a
+#          temporary run file; each chromosome is then read back as a merge
+#          of its runs, so only one exon per run is in memory at a time.
+########################################################################
+
+import heapq
+import os
+import tempfile
+
+# Rough size of one (chromosome, exonStart, exonEnd) key held in a bucket
+BYTES_PER_EXON = 200
+
+
+class ExonSorter :
+    '''
+    External sort of exon keys by chromosome, then (exonStart, exonEnd).
+
+    methods:
+    add(exon) : adds a (chromosome, exonStart, exonEnd) key.
+    chromosomeExons(chromosome) : yields the sorted, unique exons of one chromosome.
+    close() : removes the spilled run files.
+    '''
+
+    def __init__(self, maxExons=1000000, directory=None):
+        self.maxExons = max(1, maxExons)
+        self.buckets = {}
+        self.held = 0
+        self.runs = {}
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='exon_runs_', dir=directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.tmpdir.cleanup()
+
+    def add(self, exon):
+        chromosome, exonStart, exonEnd = exon
+        self.buckets.setdefault(chromosome, []).append((exonStart, exonEnd))
+        self.held += 1
+        if self.held >= self.maxExons:
+            self.spill()
+
+    def spill(self):
+        '''Writes every bucket as a sorted run file and empties the buckets.'''
+        for chromosome, exons in self.buckets.items():
+            runs = self.runs.setdefault(chromosome, [])
+            path = os.path.join(self.tmpdir.name, '{}.{}'.format(chromosome, len(runs)))
+            with open(path, 'w') as run:
+                run.writelines('{},{}\n'.format(*exon) for exon in sorted(exons))
+            runs.append(path)
+        self.buckets = {}
+        self.held = 0
+
+    @staticmethod
+    def readRun(path):
+        with open(path) as run:
+            for line in run:
+                exonStart, exonEnd = line.split(',')
+                yield int(exonStart), int(exonEnd)
+
+    def chromosomeExons(self, chromosome):
+        '''Yields the (chromosome, exonStart, exonEnd) keys of a chromosome in order, each exon once.'''
+        runs = [self.readRun(path) for path in self.runs.get(chromosome, [])]
+        runs.append(iter(sorted(self.buckets.get(chromosome, []))))
+        previous = None
+        for exon in heapq.merge(*runs):
+            if exon != previous:
+                yield (chromosome,) + exon
+                previous = exon
@@ -15,6 +15,8 @@
 #  Output files: infile_3PrimeGuideRNAs.csv
 #                infile_5PrimeGuideRNAs.csv
 #                infile_MidExonGuideRNAs.csv
+#                infile_Coverage.csv
+#                infile_ExonMap.csv
 #          
 # Author: Lauren M Sanders
 # History: LMS 11/01/16 Created
@@ -22,10 +24,39 @@
 
 import sys 
 import argparse
+import cProfile
 import csv
+import glob
+import itertools
 import os
+import re
+
+import numpy as np
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from argparse import RawTextHelpFormatter 
 
+from annotation_table import AnnotationTable
+from assembly_store import addGuideDirOptions, guideDirFromArgs
+from design_settings import DesignSettings, addSettingsOptions, settingsFromArgs
+from exon_index import IntervalIndex
+from exon_stream import BYTES_PER_EXON, ExonSorter
+from guide_candidates import GuideCandidates
+from guide_prefetch import GuidePrefetcher
+from guide_store import guideFileName, isTextGuideFile, loadGuideTable
+from output_formats import COORDINATE, FLAG, FORMATS, SCORE, STRING, fileExtension, openTable, requireArrow
+from result_cache import ResultCache
+from run_checkpoint import RunCheckpoints
+from run_metrics import RunMetrics
+
+# Rough memory (bytes) for one exon while it is designed with --max-memory: its guide candidates and selections
+DESIGN_BYTES_PER_EXON = 8192
+# Fewest exons designed per --max-memory chunk, however small the budget left beside the guide table
+MIN_CHUNK_EXONS = 100
+
+# Chromosomes designed by main, in output order
+CHROM_LIST = ['chr1,','chr2,','chr3,','chr4,','chr5,','chr6,','chr7,','chr8,', 'chr9,','chr10,','chr11,','chr12,','chr13,','chr14,','chr15,','chr16,','chr17,','chr18,','chr19,','chr20,','chr21,','chr22,','chrX,','chrY,']
+
 class CommandLine() :
     '''Implements a help option with program information, and an input file option.'''
     def __init__(self) :
@@ -33,10 +64,12 @@ class CommandLine() :
                                                             "Designed to take an input file containing the Associated_Exon_Coordinates column from a JuncBase file.\n"
                                                             "\n"
                                                             "Input file line format should be e.g. 1:1000-1100 with 1=chromosome, 1000=exonStart, 1100=exonEnd.\n"
+                                                            "chr1:1000-1100, chr1,1000,1100 and tab-separated coordinates are read as the same exon, and each exon\n"
+                                                            "is designed once however many lines name it. infile_ExonMap.csv gives the exon of every input line.\n"
                                                             "\n"
                                                             "Outputs 3 CSV files per exon coord infile; 1 file for 5' guides, 1 file for 3' guides, and 1 file for mid-exon guides.\n"
                                                             "\n"
-                                                            "The 5' and 3' files each have 12 columns as follows:\n"
+                                                            "With the default score tiers, the 5' and 3' files each have 12 columns as follows:\n"
                                                             "\n"
                                                             "chromosome = exon chromosome number\n"
                                                             "exonStart = exon start coordinate\n"
@@ -51,15 +84,86 @@ class CommandLine() :
                                                             "yellowMIT = MIT score for yellowGuide\n"
                                                             "yellowDoench = Doench score (percentage) for the yellowGuide\n"
                                                             "\n"
-                                                            "The MidExon file has 6 columns: chromosome, exonStart, exonEnd, MidExonGuide, guideMIT and guideDoench.\n",
+                                                            "With --tier or --config, each score tier adds its own nameGuide, nameMIT and nameDoench columns\n"
+                                                            "in place of the green and yellow columns.\n"
+                                                            "\n"
+                                                            "The MidExon file has 6 columns: chromosome, exonStart, exonEnd, MidExonGuide, guideMIT and guideDoench.\n"
+                                                            "\n"
+                                                            "A 4th file, infile_Coverage.csv, has one row per input exon with chromosome, exonStart, exonEnd\n"
+                                                            "and a column per guide list (nearestFivePrime, greenFivePrime, ..., midExon): 1 if a guide was found, 0 if not.\n",
                                               formatter_class=RawTextHelpFormatter,
                                               add_help = True, 
                                               usage = 'guideRNAselection.py -f exonCoordinateFileExample.txt' ## fix this!!
                                                 )
        
-        self.parser.add_argument('-f', '--filename', action='store', help='File with exon coordinates')
+        self.parser.add_argument('-f', '--filename', action='store', help='File with exon coordinates, or - for standard input')
+        self.parser.add_argument('--batch', action='store', nargs='+', metavar='FILE',
+                                 help='Design several exon files (paths or glob patterns, e.g. "comparisons/*.txt") in one run.\nGuides are assigned once for the union of their exons and each file gets its own 3 output files')
+        self.parser.add_argument('--batch-list', action='store', metavar='FILE', help='File listing exon files for --batch, one path per line')
+        self.parser.add_argument('--zero-based', action='store_true', help='Exon starts in the input are 0-based (e.g. BED) and are converted\nto the 1-based starts of JuncBase coordinates')
+        self.parser.add_argument('-o', '--output-prefix', action='store', help='Prefix of the output files (default: the input file name without extension,\nor "exons" for standard input)')
+        self.parser.add_argument('--format', action='store', choices=FORMATS, default='csv',
+                                 help='Format of the output files: csv (default), csv.gz, or parquet / arrow\nwith typed columns (needs pyarrow)')
+        self.parser.add_argument('--long', action='store_true', help='Write all guides to one infile_GuideRNAs table with one row per exon, position\n(fivePrime, threePrime, midExon) and tier, instead of the 3 guide files')
+        self.parser.add_argument('--max-memory', action='store', type=int, metavar='MB',
+                                 help='Stream exons through an external sort and design them in chunks, keeping\nmemory use, guide tables included, near this many MB. Rows are written as\neach chunk finishes. Needs guide stores (parse_crispr.py -s or -b)')
+        self.parser.add_argument('--cache', action='store', help='SQLite file caching per-exon results between runs')
+        self.parser.add_argument('--annotation', action='store', help='Annotation table from build_annotation.py; exons found in it are looked up\ninstead of designed')
+        self.parser.add_argument('--run-dir', action='store', help='Directory for per-chromosome checkpoints, written as each chromosome finishes')
+        self.parser.add_argument('--resume', action='store_true', help='Reuse the checkpoints in --run-dir of chromosomes already finished\nfor the same exons, settings and guide files')
+        self.parser.add_argument('--cache-size', action='store', type=int, default=1000000, help='Maximum number of exons kept in the cache (default 1000000)')
+        self.parser.add_argument('--progress', action='store_true', help='Show a live progress line with the time, guides scanned, candidates kept\nand peak RSS of each stage on stderr')
+        self.parser.add_argument('--metrics', action='store', help='Write per-chromosome, per-stage metrics to this file (.json, or .csv)')
+        self.parser.add_argument('--profile', action='store', help='Write a cProfile dump of the main process to this file')
+        self.parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help='Number of chromosomes to design in parallel worker processes (default 1)')
+        addGuideDirOptions(self.parser)
+        self.parser.add_argument('--prefetch', action='store', type=int, help='Chromosomes whose guides are loaded ahead in a background thread while\nthe current one is designed, with -j 1 (default 1 with guide stores,\n0 with text guide files; 0 to turn off)')
+        addSettingsOptions(self.parser)
         
         self.args = self.parser.parse_args()
+        
+    def batchFiles(self):
+        '''Returns the exon files given by --batch and --batch-list, with glob patterns expanded, each once.'''
+        paths = []
+        for pattern in self.args.batch or []:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                self.parser.error('no exon files match ' + pattern)
+            paths.extend(matches)
+        if self.args.batch_list:
+            with open(self.args.batch_list) as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        return list(dict.fromkeys(paths))
+        
+    def batchPrefixes(self):
+        '''
+        Returns a dict mapping each exon file of batchFiles() to the prefix of its output files.
+        Exits with an error when two files would write to the same output files.
+        '''
+        prefixes = {}
+        for path in self.batchFiles():
+            prefix = os.path.splitext(path)[0]
+            if prefix in prefixes.values():
+                other = next(other for other, otherPrefix in prefixes.items() if otherPrefix == prefix)
+                self.parser.error('{} and {} would both write the output files {}_*'.format(other, path, prefix))
+            prefixes[path] = prefix
+        return prefixes
+        
+    def outputPrefix(self):
+        '''Returns the prefix of the output files.'''
+        if self.args.output_prefix:
+            return self.args.output_prefix
+        if self.args.filename == '-':
+            return 'exons'
+        return os.path.splitext(self.args.filename)[0]
+        
+    def guideDir(self):
+        '''Returns the directory with the guide files: the --assembly release if given, otherwise --guide-dir.'''
+        return guideDirFromArgs(self.parser, self.args)
+        
+    def settings(self):
+        '''Returns the DesignSettings given by --config, --flank and --tier.'''
+        return settingsFromArgs(self.parser, self.args)
 
 class ExonFile : 
     '''
@@ -67,29 +171,91 @@ class ExonFile :
     which guide RNA design is desired.
             
     methods: 
-    parseFile() : returns a list of all exon coordinates and chromosomes.
+    parseFile() : returns a list of all exon coordinates and chromosomes, each exon once.
+    exons() : yields the exons of the input one at a time, from a file or standard input.
+    parseLine() : converts one exon coordinate line to the canonical format used by GuideRna.
+    chromosomeName() : returns the canonical name of a chromosome, e.g. chr1 for 1, chrX for x.
     
     '''
-    def __init__(self, commandLine) : 
+    # chromosome, exonStart and exonEnd, e.g. 1:1000-1100, chr1:1000-1100, chr1,1000,1100 or chr1<tab>1000<tab>1100
+    exonPattern = re.compile(r'\s*(?:chr)?([0-9A-Za-z_.]+?)\s*[:,\s]\s*(\d+)\s*[-,\s]\s*(\d+)', re.IGNORECASE)
+    
+    # Rows of the exon map written per batch
+    mapBatch = 65536
+    
+    def __init__(self, commandLine, filename=None) : 
         self.cL = commandLine
+        # The file to read; defaults to the -f file
+        self.filename = filename if filename is not None else commandLine.args.filename
+        # Input exon starts are 0-based (--zero-based) rather than 1-based as in JuncBase
+        self.zeroBased = commandLine.args.zero_based
+        # Number of lines that were not exon coordinates, e.g. a header
+        self.skipped = 0
         
-    def parseFile(self):
+    @staticmethod
+    def chromosomeName(name):
+        '''Adds 'chr' to a chromosome name (without it) to match the crispr files; X, Y and M(T) are upper case.'''
+        if name.isalpha():
+            name = name.upper()
+            if name == 'MT':
+                name = 'M'
+        return 'chr' + name
+        
+    @classmethod
+    def parseLine(cls, exonLine, zeroBased=False):
         '''
-        Add 'chr' before each chromosome number to match with crispr file.
-        Convert each line to CSV format. Return a list with each exon as a separate element.
+        Convert a line to the canonical CSV format, e.g. 1:1000-1100, chr1:1000-1100 and chr1 1000 1100 all become chr1,1000,1100.
+        exonStart and exonEnd are always put in order; with zeroBased, the (ordered) start is also converted from 0-based to 1-based.
+        Returns None for a blank line; raises ValueError for a line that is not an exon coordinate.
         '''
-        allExons = []
-        
-        with open (self.cL.args.filename) as f:
+        if not exonLine.strip():
+            return None
+        match = cls.exonPattern.match(exonLine)
+        if match is None:
+            raise ValueError('not an exon coordinate: ' + exonLine.strip())
+        exonStart, exonEnd = sorted((int(match.group(2)), int(match.group(3))))
+        if zeroBased:
+            exonStart += 1
+        return '{},{},{}'.format(cls.chromosomeName(match.group(1)), exonStart, exonEnd)
         
-            for exonLine in f:
-                exonLine = 'chr'+exonLine.rstrip()
-                exonLine = exonLine.replace(':',',')
-                exonLine = exonLine.replace('-',',')
-                
-                allExons.append(exonLine)
+    def lines(self):
+        '''Yields the lines of the input; a file name of - reads standard input.'''
+        if self.filename == '-':
+            yield from sys.stdin
+            return
             
-        return allExons
+        with open (self.filename) as f:
+            yield from f
+        
+    def exons(self, exonMap=None):
+        '''
+        Yields the canonical exon of each line of the input (see parseLine), skipping blank lines and counting 
+        lines that are not exon coordinates in skipped. 
+        With exonMap, an open table writer (see GuideOutput.openExonMap), every non-blank line is also written 
+        to it with its line number and canonical exon, so results can be mapped back to each input row.
+        '''
+        rows = []
+        for lineNumber, exonLine in enumerate(self.lines(), 1):
+            try:
+                exon = self.parseLine(exonLine, self.zeroBased)
+            except ValueError:
+                exon = None
+                self.skipped += 1
+            if exon is not None:
+                yield exon
+            if exonMap is not None and exonLine.strip():
+                rows.append((lineNumber, exonLine.strip()) + (exonKey(exon) if exon is not None else (None, None, None)))
+                if len(rows) >= self.mapBatch:
+                    exonMap.writeRows(rows)
+                    rows = []
+        if exonMap is not None:
+            exonMap.writeRows(rows)
+        
+    def parseFile(self, exonMap=None):
+        '''
+        Return a list with each exon of the input file as a separate element (see exons()), each exon once and in input order.
+        '''
+        return list(dict.fromkeys(self.exons(exonMap)))
 
 class GuideRna : 
     '''
@@ -99,220 +265,750 @@ class GuideRna :
     second highest score). 7 lists total.
 
     methods: 
-    rangeLists() : Returns a list of exons in range of each guide RNA location (3 lists total)
-    spliceSiteGuides() : Returns 3 lists each for 5' and 3' with guide RNAs closest to splice sites
-    given the scoring constraints of each subcategory.
+    exonCoordinates() : Returns the parsed coordinates of the exons on this chromosome.
+    exonWindows() : Returns the cutsite window of each guide RNA location for one exon.
+    windowIndexes() : Returns an interval index over each location's exon windows.
+    loadGuides() : Loads the guide table covering this chromosome's exon windows.
+    rangeLists() : Returns the (guide, exon) candidates in range of each guide RNA location (3 lists total)
+    close() : Closes the guide table loaded by rangeLists().
+    selectNearest() : Returns the guide nearest a site for each exon, for several score tiers at once.
+    tierMasks() : Returns a boolean mask per score tier over a list of candidates.
+    spliceSiteGuides() : Returns 1 list per tier (nearest, then each score tier) for each of 5' and 3' 
+    with guide RNAs closest to splice sites given the scoring constraints of each subcategory.
     midExonGuides() : Returns 1 list of guides nearest mid-exon location.
     
     '''
     
-    def __init__(self, allExons, chr) :
+    def __init__(self, allExons, chr, guides=None, metrics=None, settings=None, guideDir='.', indexes=None) :
         self.allExons = allExons
         self.chr = chr
+        # Directory with the guide files (see assembly_store.py for versioned stores)
+        self.guideDir = guideDir
+        # Window size and score tiers (see design_settings.py)
+        self.settings = settings if settings is not None else DesignSettings()
+        # An already loaded GuideTable for this chromosome; loaded from disk by rangeLists() when None
+        self.guides = guides
+        self.ownsGuides = False
+        # Window indexes of these exons (see windowIndexes()), e.g. from the prefetch that loaded guides; built by rangeLists() when None
+        self.indexes = indexes
+        # Stage timings and counts are recorded here (see run_metrics.py)
+        self.metrics = metrics if metrics is not None else RunMetrics()
+
+    def exonCoordinates(self):
+        '''Returns (chromosome, exonStart, exonEnd) for each exon on this chromosome, in input order.'''
+        exons_of_interest = []
+        
+        for exon in self.allExons:
+            if exon.startswith(self.chr):    
+                exons_of_interest.append(exonKey(exon))
+                
+        return exons_of_interest
+        
+    @staticmethod
+    def exonWindows(exonStart, exonEnd, flank=200):
+        '''
+        Returns the half-open cutsite windows (low, high) of an exon for the 
+        5' splice site, 3' splice site and mid-exon locations.
+        The splice site windows extend flank nt outside the exon.
+        '''
+        return ((exonStart-flank, int((exonEnd-exonStart)/2)+exonStart),
+                (int(((exonEnd-exonStart)/2)+exonStart), exonEnd+flank),
+                (exonStart, exonEnd))
+
+    def windowIndexes(self, exons_of_interest):
+        '''
+        Returns 3 interval indexes over the exons' cutsite windows: 5' splice site, 3' splice site and mid-exon.
+        Index queries return positions in exons_of_interest.
+        '''
+        windows = [self.exonWindows(exonStart, exonEnd, self.settings.flank) for chromosome, exonStart, exonEnd in exons_of_interest]
+        return tuple(IntervalIndex(exonWindows[location] for exonWindows in windows) for location in range(3))
 
     def rangeLists(self):
         '''
-        Returns 3 lists: one for each guide RNA location. 
-        for exon 5' splice site: all gRNAs with cutsite in range (200 nt 5' of exon start - midpoint of exon).
-        for exon 3' splice site: all gRNAs with cutsite in range (midpoint of exon - 200 nt 3' of exon end)
+        Returns 3 GuideCandidates lists: one for each guide RNA location. 
+        for exon 5' splice site: all gRNAs with cutsite in range (flank nt 5' of exon start - midpoint of exon).
+        for exon 3' splice site: all gRNAs with cutsite in range (midpoint of exon - flank nt 3' of exon end)
         for mid-exon: all gRNAs with cutsite in range (exon start - exon end)
+        
+        Guides are sorted by cutsite. Only guides inside the union of the windows are visited 
+        (found by binary search), and each is matched to its exons with an interval index query. 
+        From a block store, only the blocks overlapping that union are read.
+        Each list is ordered by guide, then by exon in input order. A candidate only holds the 
+        guide's row in the guide table and the exon's position, so the table stays open until close().
         '''
-        exons_of_interest = []
+        chrom = self.chr.rstrip(',')
         
-        for exon in self.allExons:
-            if exon.startswith(self.chr):    
-                exons_of_interest.append(exon)
+        with self.metrics.stage(chrom, 'exon filtering') as record:
+            # An exon listed more than once in the input is designed once
+            exons_of_interest = list(dict.fromkeys(self.exonCoordinates()))
+            record['candidates'] = len(exons_of_interest)
         
-        guidesInFivePrimeRange = []
-        guidesInThreePrimeRange = []
-        guidesInMidRange = []
+        indexes = self.indexes if self.indexes is not None else self.windowIndexes(exons_of_interest)
         
-        with open(self.chr + 'crispr.txt', 'r') as h:
+        with self.metrics.stage(chrom, 'guide load') as record:
+            if self.guides is None:
+                self.guides = self.loadGuides(indexes)
+                self.ownsGuides = True
+            guides = self.guides
+            record['guides'] = len(guides)
             
-            # Iterate through each crispr file only once
-            for crisprLine in h.readlines():
-                crisprLine = crisprLine.strip()
-                
-                directionality = crisprLine.split(',')[3]
-                guideStart = int(crisprLine.split(',')[1])
-                guideSeq = crisprLine.split(',')[4]
-                MITscore = crisprLine.split(',')[5]
-                DoenchScore = crisprLine.split(',')[6].split(' ')[0].replace('%','')
-                
-                if directionality == '-' :
-                        cutsite = int(guideStart+2)
-                elif directionality == '+' :
-                    cutsite = int(guideStart+16)
-                
-                # Iterate through exon file once per crispr line 
-                for exon in exons_of_interest:
-                    chromosome = exon.split(',')[0]
-                    exonStart = int(exon.split(',')[1])
-                    exonEnd = int(exon.split(',')[2])
-                    
-                    # Create a list of all gRNAs in the five prime cutsite range 
-                    try:
-                        if cutsite in range(int(exonStart-200),int((exonEnd-exonStart)/2)+exonStart) :
-                            guidesInFivePrimeRange.append((cutsite,chromosome,exonStart,exonEnd,guideSeq,MITscore,DoenchScore))
-                    except ValueError:
-                        pass
-                    
-                    # Create a list of all gRNAs in the three prime cutsite range
-                    try:
-                        if cutsite in range(int(((exonEnd-exonStart)/2)+exonStart),int(exonEnd+200)) :
-                            guidesInThreePrimeRange.append((cutsite,chromosome,exonStart,exonEnd,guideSeq,MITscore,DoenchScore))
-                    except ValueError:
-                        pass
-                        
-                    # Create a list of all gRNAs that fall within the exon 
-                    try:
-                        if cutsite in range(exonStart,exonEnd) :
-                            guidesInMidRange.append((cutsite,chromosome,exonStart,exonEnd,guideSeq,MITscore,DoenchScore))
-                    except ValueError:
-                        pass
-                        
-            h.close()
+        guidesInFivePrimeRange = GuideCandidates(guides, exons_of_interest)
+        guidesInThreePrimeRange = GuideCandidates(guides, exons_of_interest)
+        guidesInMidRange = GuideCandidates(guides, exons_of_interest)
+        
+        with self.metrics.stage(chrom, 'range assignment') as record:
+            cutsites = guides.cutsites
+            scanned = 0
+            
+            for index, guidesInRange in zip(indexes, (guidesInFivePrimeRange, guidesInThreePrimeRange, guidesInMidRange)):
+                for low, high in index.coveredRegions():
+                    first = bisect_left(cutsites, low)
+                    last = bisect_left(cutsites, high, first)
+                    scanned += last - first
+                    for guideIndex in range(first, last):
+                        for exonIndex in index.stab(cutsites[guideIndex]):
+                            guidesInRange.append(guideIndex, exonIndex)
+                            
+            record['guides'] = scanned
+            record['candidates'] = len(guidesInFivePrimeRange) + len(guidesInThreePrimeRange) + len(guidesInMidRange)
                         
         return guidesInFivePrimeRange, guidesInThreePrimeRange, guidesInMidRange
         
+    @staticmethod
+    def guideRegions(indexes):
+        '''Returns the union of the windows of several interval indexes as sorted, disjoint [low, high) pairs.'''
+        return IntervalIndex(region for index in indexes for region in index.coveredRegions()).coveredRegions()
+        
+    def loadGuides(self, indexes=None):
+        '''
+        Loads the GuideTable of this chromosome for the windows in indexes (see windowIndexes()).
+        Memory-maps chrN.guides when parse_crispr.py wrote one, otherwise reads the blocks of 
+        chrN.blocks covering the exon windows, otherwise parses chrN,crispr.txt
+        '''
+        if indexes is None:
+            indexes = self.windowIndexes(list(dict.fromkeys(self.exonCoordinates())))
+        return loadGuideTable(self.chr.rstrip(','), self.guideDir, self.guideRegions(indexes))
+        
+    def close(self):
+        '''Closes the guide table if rangeLists() loaded it.'''
+        if self.ownsGuides:
+            self.guides.close()
+            self.guides = None
+            self.ownsGuides = False
+        
+    @staticmethod
+    def candidateColumn(column, candidates):
+        '''Returns a guide table column (cutsites, mit or doench) for every candidate as a NumPy array.'''
+        return np.asarray(column)[np.frombuffer(candidates.guideIds, dtype=np.int64)]
+        
+    def selectNearest(self, candidates, sites, masks=None):
+        '''
+        Returns, for each row of masks, a list with the gRNA whose cutsite is nearest the exon's site 
+        for every exon (chromosome, exonStart, exonEnd) that has a gRNA passing the mask.
+        sites holds the target coordinate of each exon in candidates.exons. 
+        Without masks every guide is eligible.
+        
+        Candidates are sorted once by (exon, distance, position); each mask then keeps the first 
+        eligible candidate of every exon, so ties go to the guide seen first. 
+        Exons are listed in input order. Only the selected guides are built as tuples.
+        '''
+        count = len(candidates)
+        if masks is None:
+            masks = np.ones((1, count), dtype=bool)
+        if count == 0:
+            return [[] for mask in masks]
+        
+        exons = np.frombuffer(candidates.exonIds, dtype=np.int32)
+        distances = np.abs(sites[exons] - self.candidateColumn(candidates.guides.cutsites, candidates))
+        order = np.lexsort((np.arange(count), distances, exons))
+        
+        selected = []
+        for mask in masks:
+            eligible = order[mask[order]]
+            eligibleExons = exons[eligible]
+            first = np.ones(len(eligible), dtype=bool)
+            first[1:] = eligibleExons[1:] != eligibleExons[:-1]
+            selected.append([candidates.record(i) for i in eligible[first].tolist()])
+        return selected
+        
+    def tierMasks(self, candidates):
+        '''
+        Returns a (1 + number of tiers) x (number of candidates) boolean array: the first row accepts 
+        every guide ("nearest"), and each further row marks the guides in one score tier 
+        (MIT > minMIT and Doench > minDoench). All tiers are computed in one vectorized pass.
+        '''
+        mit = self.candidateColumn(candidates.guides.mit, candidates).astype(np.int16)
+        doench = self.candidateColumn(candidates.guides.doench, candidates).astype(np.int16)
+        minMIT = np.array([tier.minMIT for tier in self.settings.tiers], dtype=np.int16)
+        minDoench = np.array([tier.minDoench for tier in self.settings.tiers], dtype=np.int16)
+        
+        masks = np.ones((1 + len(self.settings.tiers), len(candidates)), dtype=bool)
+        masks[1:] = (mit > minMIT[:, None]) & (doench > minDoench[:, None])
+        return masks
+        
+    @staticmethod
+    def exonSites(candidates):
+        '''Returns the exon starts, exon ends and exon midpoints of candidates.exons as NumPy arrays.'''
+        exonStarts = np.array([exon[1] for exon in candidates.exons], dtype=np.float64)
+        exonEnds = np.array([exon[2] for exon in candidates.exons], dtype=np.float64)
+        return exonStarts, exonEnds, ((exonEnds-exonStarts)/2)+exonStarts
+        
     def spliceSiteGuides(self, guidesInFivePrimeRange, guidesInThreePrimeRange) :
         '''
-        Returns 3 lists for each splice site location: 
-        "nearest" = gRNA with splice site nearest splice site
-        "green" = gRNA with MIT>50 and Doench>60 closest to splice site
-        "yellow" = gRNA with MIT>50 and Doench>30 closest to splice site
+        Returns a list for each tier of each splice site location, 5' tiers first: 
+        "nearest" = gRNA with cutsite nearest splice site
+        then for each score tier in self.settings (by default "green" = MIT>50 and Doench>60, 
+        "yellow" = MIT>50 and Doench>30), the gRNA in that tier closest to the splice site.
+        
+        The 5' splice site is the exon start and the 3' splice site is the exon end.
         '''
+        chrom = self.chr.rstrip(',')
         
-        # Now we have three lists, holding ANY gRNA that exists in the 5', 3', or midexon range
-        # The next step is to divide the 5' and 3' gRNAs up into the following categories: 
-        # 1. "green" scores (MIT>50 and Doench>60)
-        # 2. "yellow" scores (MIT>50 and Doench>30
-        # 3. the gRNA that exists closest to the splice site itself, regardless of score
-       
-        # Create a list of five prime gRNAs that score in the "green" range
-        greenFiveCandidates = []
-        for guide in guidesInFivePrimeRange:
-            if int(guide[5])>50 and int(guide[6])>60:
-                greenFiveCandidates.append(guide)
-        
-        # Create a list of five prime gRNAs that score in the "yellow" range
-        yellowFiveCandidates = []
-        for guide in guidesInFivePrimeRange:
-            if int(guide[5])>50 and int(guide[6])>30:
-                yellowFiveCandidates.append(guide)
-        
-        # Create a list of three prime gRNAs that score in the "green" range
-        greenThreeCandidates = []
-        for guide in guidesInFivePrimeRange:
-            if int(guide[5])>50 and int(guide[6])>60:
-                greenThreeCandidates.append(guide)
-        
-        # Create a list of three prime gRNAs that score in the "yellow" range
-        yellowThreeCandidates = []
-        for guide in guidesInFivePrimeRange:
-            if int(guide[5])>50 and int(guide[6])>30:
-                yellowThreeCandidates.append(guide)
-        
-        def distance(guideRNA) :
-            '''Returns distance between gRNA cutsite and exonStart'''
-            
-            cutsite = guideRNA[0]
-            exonStart = guideRNA[2]
-            
-            distance = int(abs(exonStart-cutsite))
-            return distance
-            
-        def nearestGuides(guideRangeList) :
-            '''Returns guideRNAs nearest splice site in a given list of gRNAs'''
-            
-            guides_to_remove = []
-            nearestGuides = []
-            guides_left = True 
-            guideRangeListLength = len(guideRangeList)
-            while guides_left == True:
-            
-                same_exon = []
-                distances = []
-                
-                try:
-                    same_exon.append(guideRangeList[0])
-                except IndexError: 
-                    pass
-                
-                for j in range(1,len(guideRangeList)): 
-                    if guideRangeList[0][2] == guideRangeList[j][2] : 
-                        same_exon.append(guideRangeList[j])
-                        
-                for guide in same_exon: 
-                    guideRangeList.remove(guide)
-                    distances.append(distance(guide))
-                try: 
-                    nearestGuides.append(same_exon[distances.index(max(distances))])
-                except ValueError:
-                    pass
-                    
-                if len(guideRangeList) == 0 : 
-                    guides_left = False
-                    break
-            
-            return nearestGuides
-            
-        nearestFivePrime = nearestGuides(guidesInFivePrimeRange)
-        greenFivePrime = nearestGuides(greenFiveCandidates)
-        yellowFivePrime = nearestGuides(yellowFiveCandidates)
-       
-        nearestThreePrime = nearestGuides(guidesInThreePrimeRange)
-        greenThreePrime = nearestGuides(greenThreeCandidates)
-        yellowThreePrime = nearestGuides(yellowThreeCandidates)
-       
+        with self.metrics.stage(chrom, 'tier filtering') as record:
+            fivePrimeMasks = self.tierMasks(guidesInFivePrimeRange)
+            threePrimeMasks = self.tierMasks(guidesInThreePrimeRange)
+            record['guides'] = len(guidesInFivePrimeRange) + len(guidesInThreePrimeRange)
+            record['candidates'] = int(fivePrimeMasks[1:].sum() + threePrimeMasks[1:].sum())
+        
+        with self.metrics.stage(chrom, 'splice site selection') as record:
+            exonStarts = self.exonSites(guidesInFivePrimeRange)[0]
+            exonEnds = self.exonSites(guidesInThreePrimeRange)[1]
+            fivePrime = self.selectNearest(guidesInFivePrimeRange, exonStarts, fivePrimeMasks)
+            threePrime = self.selectNearest(guidesInThreePrimeRange, exonEnds, threePrimeMasks)
+            record['guides'] = len(guidesInFivePrimeRange) + len(guidesInThreePrimeRange)
+            record['candidates'] = sum(map(len, fivePrime + threePrime))
        
-        return nearestFivePrime, greenFivePrime, yellowFivePrime, nearestThreePrime, greenThreePrime, yellowThreePrime
+        return tuple(fivePrime + threePrime)
         
 
     def midExonGuides(self, guideRangeList) :
         '''Returns a list of gRNAs, one nearest the midway point of each exon'''
+            
+        with self.metrics.stage(self.chr.rstrip(','), 'mid-exon selection') as record:
+            midpoints = self.exonSites(guideRangeList)[2]
+            midExon = self.selectNearest(guideRangeList, midpoints)[0]
+            record['guides'] = len(guideRangeList)
+            record['candidates'] = len(midExon)
         
-        def distance(guideRNA) :
-            '''Calculates the distance between a gRNA cutsite and the midway point of an exon'''
+        return midExon
+
+def designChromosome(allExons, chrom, guides=None, metrics=None, settings=None, guideDir='.', indexes=None):
+    '''
+    Designs guide RNAs for the exons on one chromosome (chrom as in chromList, e.g. 'chr1,').
+    guides is an optional, already loaded GuideTable for the chromosome (otherwise it is read 
+    from guideDir), metrics an optional RunMetrics recording each stage and settings optional DesignSettings.
+    indexes are the exons' window indexes when already built with the guides (see prefetchChromosome).
+    Returns one guide list per name in settings.selectionNames(): by default nearest, green and 
+    yellow 5' guides, nearest, green and yellow 3' guides, and mid-exon guides.
+    '''
+    newGuides = GuideRna(allExons, chrom, guides, metrics, settings, guideDir, indexes)
+    
+    try:
+        guidesInFivePrimeRange, guidesInThreePrimeRange, guidesInMidRange = newGuides.rangeLists()
+        
+        spliceSiteGuides = newGuides.spliceSiteGuides(guidesInFivePrimeRange, guidesInThreePrimeRange)
+        
+        midExonGuides = newGuides.midExonGuides(guidesInMidRange)
+    finally:
+        newGuides.close()
+    
+    return spliceSiteGuides + (midExonGuides,)
+    
+def prefetchChromosome(allExons, chrom, settings=None, guideDir='.'):
+    '''
+    Loads the GuideTable designChromosome needs for allExons on chrom and starts reading it ahead (see GuidePrefetcher).
+    Returns the table and the window indexes it was loaded for, so designChromosome does not build them again.
+    '''
+    newGuides = GuideRna(allExons, chrom, settings=settings, guideDir=guideDir)
+    indexes = newGuides.windowIndexes(list(dict.fromkeys(newGuides.exonCoordinates())))
+    guides = newGuides.loadGuides(indexes)
+    guides.prefetch()
+    return guides, indexes
+    
+def designChromosomeWorker(allExons, chrom, settings=None, guideDir='.'):
+    '''Runs designChromosome in a worker process; returns the result and the worker's stage metric records.'''
+    metrics = RunMetrics()
+    return designChromosome(allExons, chrom, metrics=metrics, settings=settings, guideDir=guideDir), metrics.records
+    
+def exonKey(exon):
+    '''Returns the (chromosome, exonStart, exonEnd) key of an exon from ExonFile.parseFile.'''
+    chromosome, exonStart, exonEnd = exon.split(',')[:3]
+    return chromosome, int(exonStart), int(exonEnd)
+    
+def fileExonKeys(allExons):
+    '''Returns the key of each exon of an exon file (from ExonFile.parseFile), once each and in file order.'''
+    return list(dict.fromkeys(exonKey(exon) for exon in allExons))
+    
+def exonSelections(result):
+    '''
+    Regroups the guide lists returned by designChromosome by exon.
+    Returns a dict mapping each exon key to one guide per list, with None where a list has no guide for the exon.
+    '''
+    selections = {}
+    for tier, guides in enumerate(result):
+        for guide in guides:
+            selections.setdefault(guide[1:4], [None] * len(result))[tier] = guide
+    return selections
+    
+def selectionLists(selections, count):
+    '''Turns a dict from exonSelections back into count guide lists, ordered by exonStart, then exonEnd.'''
+    lists = [[] for i in range(count)]
+    for exon in sorted(selections, key=lambda exon: exon[1:]):
+        for guides, guide in zip(lists, selections[exon]):
+            if guide is not None:
+                guides.append(guide)
+    return lists
+    
+def runChromosomes(exonsByChrom, jobs=1, metrics=None, settings=None, guideDir='.', prefetch=None, guides=None):
+    '''
+    Runs designChromosome for every chromosome in the exonsByChrom dict that has exons, 
+    yielding (chrom, result) pairs as chromosomes finish.
+    With one job, the guide tables of the next prefetch chromosomes are loaded in a background 
+    thread while the current one is designed (prefetch 0 loads each table in turn). prefetch None 
+    loads 1 ahead when every chromosome's guides come from a store, and 0 when any is a text file, 
+    which would be parsed in the thread while holding the interpreter lock.
+    With jobs > 1, chromosomes are sent to a pool of worker processes, largest guide file first.
+    Each worker only receives the exons of its own chromosome.
+    A failure in a worker is raised as a RuntimeError naming the chromosome.
+    Stage metrics, including those of worker processes, are added to metrics.
+    guides is an optional dict of GuideTables already loaded for some chromosomes; those chromosomes 
+    are designed first, in this process, with the given table (which is left open).
+    '''
+    work = [chrom for chrom, exons in exonsByChrom.items() if exons]
+    
+    if guides:
+        for chrom in [chrom for chrom in work if chrom in guides]:
+            yield chrom, designChromosome(exonsByChrom[chrom], chrom, guides[chrom], metrics, settings, guideDir)
+        work = [chrom for chrom in work if chrom not in guides]
+    
+    if prefetch is None:
+        prefetch = 0 if any(isTextGuideFile(guideFileName(chrom.rstrip(','), guideDir)) for chrom in work) else 1
+    
+    if jobs <= 1 and prefetch <= 0:
+        for chrom in work:
+            yield chrom, designChromosome(exonsByChrom[chrom], chrom, metrics=metrics, settings=settings, guideDir=guideDir)
+        return
+        
+    if jobs <= 1:
+        with GuidePrefetcher(work, lambda chrom: prefetchChromosome(exonsByChrom[chrom], chrom, settings, guideDir), prefetch, metrics) as prefetcher:
+            for i in range(len(work)):
+                chrom, guides, indexes = prefetcher.get()
+                try:
+                    result = designChromosome(exonsByChrom[chrom], chrom, guides, metrics, settings, guideDir, indexes)
+                finally:
+                    guides.close()
+                yield chrom, result
+        return
+    
+    def guideFileSize(chrom):
+        try:
+            return os.path.getsize(guideFileName(chrom.rstrip(','), guideDir))
+        except OSError:
+            return 0
+    
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for chrom in sorted(work, key=guideFileSize, reverse=True):
+            futures[pool.submit(designChromosomeWorker, exonsByChrom[chrom], chrom, settings, guideDir)] = chrom
             
-            cutsite = guideRNA[0]
-            exonStart = guideRNA[2]
-            exonEnd = guideRNA[3]
+        for future in as_completed(futures):
+            chrom = futures[future]
+            try:
+                result, records = future.result()
+            except Exception as err:
+                for pending in futures:
+                    pending.cancel()
+                raise RuntimeError("Guide RNA design failed for " + chrom.rstrip(',')) from err
+            if metrics is not None:
+                metrics.extend(records)
+            yield chrom, result
+    
+def designChromosomes(allExons, chromList, jobs=1, cache=None, metrics=None, settings=None, quiet=False, guideDir='.', checkpoints=None, prefetch=None, annotation=None, guides=None):
+    '''
+    Designs guide RNAs for every chromosome in chromList and yields the guide lists 
+    of each chromosome (see designChromosome), in chromList order. A chromosome is yielded as soon as 
+    it and every chromosome before it are done, so its rows can be written while later ones are designed.
+    Within a chromosome, guides are ordered by exon.
+    
+    With a ResultCache, exons already cached for the current guide file and selection settings 
+    are taken from the cache, only the remaining exons are designed, and their results are added 
+    to the cache (including exons for which no guides were found).
+    With an AnnotationTable built for the same settings and guide files, exons of the annotation 
+    are looked up in the table, before the cache, and only the others are designed.
+    With RunCheckpoints, every finished chromosome is checkpointed, and when resuming, chromosomes 
+    with a checkpoint for the same exons, settings and guide file are not designed again.
+    Each finished chromosome is printed unless quiet is set.
+    guides optionally maps chromosomes to already loaded GuideTables (see runChromosomes).
+    '''
+    settings = settings if settings is not None else DesignSettings()
+    metrics = metrics if metrics is not None else RunMetrics()
+    count = len(settings.selectionNames())
+    exonsByChrom = {chrom: [exon for exon in allExons if exon.startswith(chrom)] for chrom in chromList}
+    selectionsByChrom = {chrom: {} for chrom in chromList}
+    fingerprints = {}
+    checkpointKeys = {}
+    
+    if checkpoints is not None:
+        for chrom in chromList:
+            if exonsByChrom[chrom]:
+                checkpointKeys[chrom] = checkpoints.key([exonKey(exon) for exon in exonsByChrom[chrom]], settings.key(), guideFileName(chrom.rstrip(','), guideDir))
+                saved = checkpoints.load(chrom.rstrip(','), checkpointKeys[chrom])
+                if saved is not None:
+                    selectionsByChrom[chrom] = saved
+                    exonsByChrom[chrom] = []
+                    if not quiet:
+                        print("Resumed guide RNAs for", chrom.rstrip(','), "from checkpoint")
+    
+    if annotation is not None:
+        for chrom in chromList:
+            if exonsByChrom[chrom] and annotation.usable(chrom.rstrip(','), settings.key(), guideFileName(chrom.rstrip(','), guideDir)):
+                with metrics.stage(chrom.rstrip(','), 'annotation lookup') as record:
+                    selectionsByChrom[chrom].update(annotation.lookup([exonKey(exon) for exon in exonsByChrom[chrom]]))
+                    exonsByChrom[chrom] = [exon for exon in exonsByChrom[chrom] if exonKey(exon) not in selectionsByChrom[chrom]]
+                    record['candidates'] = len(selectionsByChrom[chrom])
+    
+    if cache is not None:
+        for chrom in chromList:
+            if exonsByChrom[chrom]:
+                fingerprints[chrom] = cache.guideFingerprint(guideFileName(chrom.rstrip(','), guideDir))
+                selectionsByChrom[chrom].update(cache.lookup([exonKey(exon) for exon in exonsByChrom[chrom]], settings.key(), fingerprints[chrom]))
+                exonsByChrom[chrom] = [exon for exon in exonsByChrom[chrom] if exonKey(exon) not in selectionsByChrom[chrom]]
+    
+    # Chromosomes still being designed, and the position in chromList of the next one to yield
+    remaining = {chrom for chrom in chromList if exonsByChrom[chrom]}
+    ready = 0
+    for chrom, result in runChromosomes(exonsByChrom, jobs, metrics, settings, guideDir, prefetch, guides):
+        selections = exonSelections(result)
+        
+        if cache is not None:
+            cache.store({exonKey(exon): selections.get(exonKey(exon), [None] * count) for exon in exonsByChrom[chrom]}, settings.key(), fingerprints[chrom])
             
-            distance = int(abs((((exonEnd-exonStart)/2)+exonStart)-cutsite))
-            return distance
+        selectionsByChrom[chrom].update(selections)
+        if checkpoints is not None:
+            checkpoints.save(chrom.rstrip(','), checkpointKeys[chrom], selectionsByChrom[chrom])
+        if not quiet:
+            print("Finished guide RNAs for", chrom.rstrip(','))
+        
+        remaining.discard(chrom)
+        while ready < len(chromList) and chromList[ready] not in remaining:
+            yield selectionLists(selectionsByChrom.pop(chromList[ready]), count)
+            ready += 1
+        
+    for chrom in chromList[ready:]:
+        yield selectionLists(selectionsByChrom.pop(chrom), count)
+    
+def streamChromosomes(sorter, chromList, budget, cache=None, metrics=None, settings=None, guideDir='.', annotation=None):
+    '''
+    Designs guide RNAs for the exons of an ExonSorter, chromosome by chromosome in chromList order. 
+    Each chromosome's guide table is loaded once (from its chrN.guides or chrN.blocks store) and its exons 
+    are designed in chunks against it, as many exons per chunk as fit in budget bytes beside the table 
+    (DESIGN_BYTES_PER_EXON each, at least MIN_CHUNK_EXONS). Yields (exon keys, guide lists) for every chunk 
+    as soon as it is designed; the guide lists are those of designChromosomes, ordered by exon. 
+    Only one guide table and one chunk of exons and its candidates are held in memory at a time.
+    '''
+    metrics = metrics if metrics is not None else RunMetrics()
+    for chrom in chromList:
+        exons = sorter.chromosomeExons(chrom.rstrip(','))
+        first = next(exons, None)
+        if first is None:
+            continue
+        
+        with metrics.stage(chrom.rstrip(','), 'guide load') as record:
+            guides = loadGuideTable(chrom.rstrip(','), guideDir)
+            record['guides'] = len(guides)
+        try:
+            chunkExons = max(MIN_CHUNK_EXONS, (budget - guides.nbytes()) // DESIGN_BYTES_PER_EXON)
+            if guides.nbytes() > budget:
+                print("The {} guide table ({:,} MB) is larger than the --max-memory design budget; designing {} exons at a time".format(chrom.rstrip(','), guides.nbytes() >> 20, chunkExons))
+            exons = itertools.chain([first], exons)
+            while True:
+                chunk = list(itertools.islice(exons, chunkExons))
+                if not chunk:
+                    break
+                allExons = ['{},{},{}'.format(*exon) for exon in chunk]
+                yield chunk, next(designChromosomes(allExons, [chrom], 1, cache, metrics, settings, True, guideDir, annotation=annotation, guides={chrom: guides}))
+        finally:
+            guides.close()
+        print("Finished guide RNAs for", chrom.rstrip(','))
+
+class GuideOutput : 
+    '''
+    Writes the output files for an exon coordinate file: the 3 guide files (5' splice site, 3' splice site 
+    and mid-exon) and the per-exon coverage table. With the long layout, the guides of every position and 
+    tier go to one table instead, with one row per exon, position and tier.
+    Files are written in outputFormat (csv, csv.gz, parquet or arrow; see output_formats.py). Guides are 
+    appended one chromosome (or chunk) at a time; the nearest and score tier guides of each splice site 
+    are joined on the exon (chromosome, exonStart, exonEnd) in memory, and each batch of joined rows is 
+    written straight to its final file.
+    
+    methods: 
+    open() : Opens the guide files; also done by using the GuideOutput as a context manager.
+    writeGuides() : Appends the rows of one chromosome's guide lists to the guide files.
+    close() : Closes the guide files.
+    guideFiles() : Returns the paths of the guide files.
+    joinTiers() : Returns the guides of several tier lists grouped by exon.
+    spliceSiteRows() : Returns the 5' or 3' rows with the nearest and score tier guides per exon.
+    midExonRows() : Returns the mid-exon rows.
+    longRows() : Returns the long layout rows, one per guide.
+    writeCoverage() : Writes the coverage table and returns the exons without 5', 3' or mid-exon guides.
+    openExonMap() : Opens the exon map, which gives the canonical exon of every input line (see ExonFile.exons).
+    writeStream() : Writes the guide files and coverage table chunk by chunk from streamChromosomes().
+    '''
+    
+    exonColumns = [('chromosome', STRING), ('exonStart', COORDINATE), ('exonEnd', COORDINATE)]
+    midExonColumns = exonColumns + [('midExonGuide', STRING), ('MIT', SCORE), ('Doench', SCORE)]
+    longColumns = exonColumns + [('position', STRING), ('tier', STRING), ('guide', STRING), ('MIT', SCORE), ('Doench', SCORE)]
+    exonMapColumns = [('line', COORDINATE), ('input', STRING)] + exonColumns
+    gap = (None, None, None)
+    
+    def __init__(self, prefix, settings=None, outputFormat='csv', long=False) :
+        settings = settings if settings is not None else DesignSettings()
+        self.outputFormat = outputFormat
+        self.long = long
+        self.tierCount = len(settings.tierNames())
+        self.spliceSiteColumns = self.exonColumns + [(name + column, columnType) for name in settings.tierNames() 
+                                                     for column, columnType in (('Guide', STRING), ('MIT', SCORE), ('Doench', SCORE))]
+        self.coverageColumns = self.exonColumns + [(name, FLAG) for name in settings.selectionNames()]
+        # (position, tier) of each guide list, in DesignSettings.selectionNames() order; the mid-exon guide is the nearest to mid-exon
+        self.selectionLabels = ([('fivePrime', name) for name in settings.tierNames()] + 
+                                [('threePrime', name) for name in settings.tierNames()] + [('midExon', 'nearest')])
+        # Position of the nearest 5' and 3' guide and the mid-exon guide in a selection
+        self.locations = (0, self.tierCount, len(self.selectionLabels) - 1)
+        extension = fileExtension(outputFormat)
+        self.fivePrimeFile = prefix + '_5PrimeGuideRNAs' + extension
+        self.threePrimeFile = prefix + '_3PrimeGuideRNAs' + extension
+        self.midExonFile = prefix + '_MidExonGuideRNAs' + extension
+        self.longFile = prefix + '_GuideRNAs' + extension
+        self.coverageFile = prefix + '_Coverage' + extension
+        self.exonMapFile = prefix + '_ExonMap' + extension
+        self.writers = None
         
+    def __enter__(self):
+        self.open()
+        return self
         
-        guides_to_remove = []
-        nearestGuides = []
-        guides_left = True 
-        while guides_left == True:
+    def __exit__(self, *exc):
+        self.close()
+        
+    def guideFiles(self):
+        if self.long:
+            return [self.longFile]
+        return [self.fivePrimeFile, self.threePrimeFile, self.midExonFile]
+        
+    def open(self):
+        if self.long:
+            self.writers = [openTable(self.longFile, self.longColumns, self.outputFormat)]
+        else:
+            self.writers = [openTable(self.fivePrimeFile, self.spliceSiteColumns, self.outputFormat),
+                            openTable(self.threePrimeFile, self.spliceSiteColumns, self.outputFormat),
+                            openTable(self.midExonFile, self.midExonColumns, self.outputFormat)]
+        
+    def close(self):
+        for writer in self.writers or []:
+            writer.close()
+        self.writers = None
+        
+    def writeGuides(self, guides):
+        '''
+        Appends the rows of one chromosome's (or chunk's) guide lists, as from designChromosomes(), 
+        to the open guide files. Returns the number of rows written.
+        '''
+        if self.long:
+            rows = self.longRows(guides)
+            self.writers[0].writeRows(rows)
+            return len(rows)
         
-            same_exon = []
-            distances = []
+        batches = (self.spliceSiteRows(*guides[:self.tierCount]), 
+                   self.spliceSiteRows(*guides[self.tierCount:2 * self.tierCount]), 
+                   self.midExonRows(guides[-1]))
+        for writer, rows in zip(self.writers, batches):
+            writer.writeRows(rows)
+        return sum(map(len, batches))
+        
+    @staticmethod
+    def joinTiers(*tierLists):
+        '''
+        Returns a dict mapping each exon key to a list with its guide from every tier list (None where a tier has no guide).
+        Exons are ordered by their first appearance, taking the tier lists in order.
+        '''
+        joined = {}
+        for tier, guides in enumerate(tierLists):
+            for guide in guides:
+                exon = guide[1:4]
+                if exon not in joined:
+                    joined[exon] = [None] * len(tierLists)
+                joined[exon][tier] = guide
+        return joined
+        
+    def spliceSiteRows(self, *tierLists):
+        '''Returns one row per exon with its guide from each tier list (nearest, then each score tier); missing tiers are None.'''
+        rows = []
+        for exon, guides in self.joinTiers(*tierLists).items():
+            row = list(exon)
+            for guide in guides:
+                row.extend(guide[4:] if guide is not None else self.gap)
+            rows.append(row)
+        return rows
+        
+    @staticmethod
+    def midExonRows(midExon):
+        '''Returns one row per exon with its mid-exon guide.'''
+        return [guide[1:] for guide in midExon]
+        
+    def longRows(self, guides):
+        '''Returns one row per guide of the guide lists: the exon, position, tier and guide, ordered by exon.'''
+        rows = []
+        selections = exonSelections(guides)
+        for exon in sorted(selections, key=lambda exon: exon[1:]):
+            for (position, tier), guide in zip(self.selectionLabels, selections[exon]):
+                if guide is not None:
+                    rows.append(exon + (position, tier) + guide[4:])
+        return rows
+        
+    def openExonMap(self):
+        '''Returns an open table writer for the exon map: line number, input line, then the canonical chromosome, exonStart and exonEnd.'''
+        return openTable(self.exonMapFile, self.exonMapColumns, self.outputFormat)
+        
+    def writeCoverage(self, exonKeys, selections):
+        '''
+        Writes one row per exon key (each once, in order) with 1 for every selection list 
+        (see DesignSettings.selectionNames) that has a guide for the exon and 0 where it has none. 
+        selections is a dict of exon key -> selection, as from exonSelections(); exons not in it have no guides.
+        Returns 3 lists with the exons without a 5', 3' and mid-exon guide.
+        '''
+        writer = openTable(self.coverageFile, self.coverageColumns, self.outputFormat)
+        try:
+            return self.writeCoverageRows(writer, exonKeys, selections)
+        finally:
+            writer.close()
             
-            try:
-                same_exon.append(guideRangeList[0])
-            except IndexError: 
-                pass
+    def writeCoverageRows(self, writer, exonKeys, selections):
+        '''Writes the rows of writeCoverage() with an open table writer. Returns the exons without a 5', 3' and mid-exon guide.'''
+        missed = ([], [], [])
+        rows = []
+        for exon in dict.fromkeys(exonKeys):
+            selection = selections.get(exon)
+            found = [int(guide is not None) for guide in selection] if selection is not None else [0] * len(self.selectionLabels)
+            rows.append(exon + tuple(found))
+            # Every exon with a guide has a nearest guide, the first list of each location
+            for location, missedExons in zip(self.locations, missed):
+                if not found[location]:
+                    missedExons.append(exon)
+        writer.writeRows(rows)
+        return missed
+        
+    def writeStream(self, chunks, missed):
+        '''
+        Writes the guide files and coverage table from the (exon keys, guide lists) chunks of streamChromosomes(), 
+        appending each chunk's rows as it arrives. missed holds 3 open files to which the exons 
+        of each chunk without a 5', 3' or mid-exon guide are written, one per line as e.g. 1-1000-1100.
+        Returns the number of rows written.
+        '''
+        rows = 0
+        coverage = openTable(self.coverageFile, self.coverageColumns, self.outputFormat)
+        try:
+            with self:
+                for exons, guides in chunks:
+                    rows += self.writeGuides(guides)
+                    for missedExons, missedFile in zip(self.writeCoverageRows(coverage, exons, exonSelections(guides)), missed):
+                        missedFile.writelines('{}-{}-{}\n'.format(exon[0][3:], exon[1], exon[2]) for exon in missedExons)
+        finally:
+            coverage.close()
+        return rows
+
+def reportSkippedLines(exonFile, output):
+    '''Prints the number of lines of an ExonFile that were not exon coordinates, if any.'''
+    if exonFile.skipped:
+        print("Skipped {} lines of {} that are not exon coordinates (listed without an exon in {})".format(
+              exonFile.skipped, exonFile.filename, output.exonMapFile))
+
+def reportMissingExons(missed):
+    '''Prints the exons without a 5', 3' or mid-exon guide, as returned by GuideOutput.writeCoverage(), e.g. 1-1000-1100.'''
+    for location, exons in zip(("5' splice site", "3' splice site", "mid-exon"), missed):
+        print("No {} guide RNAs were found for the following exons:".format(location))
+        for exon in exons:
+            print('{}-{}-{}'.format(exon[0][3:], exon[1], exon[2]))
+
+def batchMain(cL, cache, metrics, settings, guideDir='.', checkpoints=None, annotation=None):
+    '''
+    Designs several exon files in one run (--batch). The exons of all files are designed together, 
+    so each chromosome's guides are read and assigned once; the selections are then written out to 
+    each file's own 3 output files, named as for -f.
+    '''
+    count = len(settings.selectionNames())
+    
+    outputs = {path: GuideOutput(prefix, settings, cL.args.format, cL.args.long) for path, prefix in cL.batchPrefixes().items()}
+    with metrics.stage('all', 'exon file read') as record:
+        exonsByFile = {}
+        for path, output in outputs.items():
+            exonFile = ExonFile(cL, path)
+            with output.openExonMap() as exonMap:
+                exonsByFile[path] = exonFile.parseFile(exonMap)
+            reportSkippedLines(exonFile, output)
+        # Union of all exons, each once
+        allExons = list(dict.fromkeys(exon for exons in exonsByFile.values() for exon in exons))
+        record['candidates'] = len(allExons)
+        
+    selections = {}
+    for chromosomeGuides in designChromosomes(allExons, CHROM_LIST, cL.args.jobs, cache, metrics, settings, guideDir=guideDir, checkpoints=checkpoints, prefetch=cL.args.prefetch, annotation=annotation):
+        selections.update(exonSelections(chromosomeGuides))
+        
+    for path, exons in exonsByFile.items():
+        output = outputs[path]
+        with metrics.stage('all', 'output join') as record, output:
+            # Each file's guide lists, in the chromosome and exon order of a single-file run
+            record['guides'] = record['candidates'] = 0
+            for chrom in CHROM_LIST:
+                keys = {exonKey(exon) for exon in exons if exon.startswith(chrom)}
+                chromosomeGuides = selectionLists({key: selections[key] for key in keys if key in selections}, count)
+                record['guides'] += sum(map(len, chromosomeGuides))
+                record['candidates'] += output.writeGuides(chromosomeGuides)
             
-            for j in range(1,len(guideRangeList)): 
-                if guideRangeList[0][2] == guideRangeList[j][2] : 
-                    same_exon.append(guideRangeList[j])
-                    
-            for guide in same_exon: 
-                guideRangeList.remove(guide)
-                distances.append(distance(guide))
-            try: 
-                nearestGuides.append(same_exon[distances.index(max(distances))])
-            except ValueError:
-                pass
-                
-            if len(guideRangeList) == 0 : 
-                guides_left = False
-                break
+        print("Finished designing guide RNAs for", path)
+        print("5' splice site, 3' splice site, and mid-exon gRNAs can be found in the following files:")
+        for guideFile in output.guideFiles():
+            print(guideFile)
+        with metrics.stage('all', 'missing-exon report') as record:
+            missed = output.writeCoverage(fileExonKeys(exons), selections)
+            record['candidates'] = sum(map(len, missed))
+        print("Per-exon coverage of each position and score tier is in", output.coverageFile)
+        reportMissingExons(missed)
+
+def streamMain(cL, output, cache, metrics, settings, guideDir='.', annotation=None):
+    '''
+    Runs a design with bounded memory (--max-memory): the exons are sorted externally by chromosome 
+    and position, designed a chunk at a time, and each chunk's rows are written as soon as it is done. 
+    All rows, including those of the coverage table, come out in chromosome and position order rather than 
+    input order (the exon map keeps the input order). Exons without guides are collected in temporary files 
+    and reported at the end, in the same order.
+    '''
+    budget = cL.args.max_memory << 20
+    # Half of the budget holds unsorted exons, the other half a chromosome's guide table and a chunk of exons with its guide candidates
+    with ExonSorter(max(1, budget // 2 // BYTES_PER_EXON)) as sorter:
+        exonFile = ExonFile(cL)
+        with metrics.stage('all', 'exon sort') as record, output.openExonMap() as exonMap:
+            record['candidates'] = 0
+            for exon in exonFile.exons(exonMap):
+                sorter.add(exonKey(exon))
+                record['candidates'] += 1
+        reportSkippedLines(exonFile, output)
+        
+        missedFiles = [os.path.join(sorter.tmpdir.name, name) for name in ('missed5', 'missed3', 'missedMid')]
+        with open(missedFiles[0], 'w') as missedFive, open(missedFiles[1], 'w') as missedThree, open(missedFiles[2], 'w') as missedMid:
+            chunks = streamChromosomes(sorter, CHROM_LIST, budget // 2, cache, metrics, settings, guideDir, annotation)
+            output.writeStream(chunks, (missedFive, missedThree, missedMid))
+        
+        print("Finished designing guide RNAs for the given exons.")
+        print("5' splice site, 3' splice site, and mid-exon gRNAs can be found in the following files:")
+        for guideFile in output.guideFiles():
+            print(guideFile)
+        print("Per-exon coverage of each position and score tier is in", output.coverageFile)
         
-        return nearestGuides        
+        for location, path in zip(("5' splice site", "3' splice site", "mid-exon"), missedFiles):
+            print("No {} guide RNAs were found for the following exons:".format(location))
+            with open(path) as missed:
+                for exon in missed:
+                    print(exon, end='')
 
 def main(cL=None):
     '''
@@ -320,224 +1016,107 @@ def main(cL=None):
     Passes each chromosome number to the GuideRNA class. 
     Retrieves lists of gRNAs for each subcategory of each position, 
     all chromosomes included. 
-    Writes all gRNAs to 3 files, one for each position.
+    Writes all gRNAs to 3 files, one for each position, appending each chromosome as it finishes.
+    With --max-memory, exons are streamed instead (see streamMain), 
+    and with --batch several exon files are designed together (see batchMain).
     '''
     cL = CommandLine ()
     
-    allExons = ExonFile(cL).parseFile()
+    profiler = None
+    if cL.args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    metrics = RunMetrics(sys.stderr if cL.args.progress else None)
     
-    chromList = ['chr1,','chr2,','chr3,','chr4,','chr5,','chr6,','chr7,','chr8,', 'chr9,','chr10,','chr11,','chr12,','chr13,','chr14,','chr15,','chr16,','chr17,','chr18,','chr19,','chr20,','chr21,','chr22,','chrX,','chrY,']
-
-    # Lists for each of the 7 types; with ALL chromosomes in one list
-    allnearestFivePrime = []
-    allgreenFivePrime = []
-    allyellowFivePrime = []
-    allnearestThreePrime = []
-    allgreenThreePrime = []
-    allyellowThreePrime = []
-    allMidExon = []
-    
-    for chrom in chromList:
-        print("Finished guide RNAs for", chrom)
-        
-        newGuides = GuideRna(allExons, chrom)
+    chromList = CHROM_LIST
+    settings = cL.settings()
+    guideDir = cL.guideDir()
+    batch = cL.args.batch or cL.args.batch_list
+    if batch and (cL.args.filename or cL.args.max_memory is not None or cL.args.output_prefix):
+        cL.parser.error('--batch cannot be combined with -f, -o or --max-memory')
+    if not batch and not cL.args.filename:
+        cL.parser.error('an exon file is required: -f FILE, or --batch')
+    if cL.args.resume and not cL.args.run_dir:
+        cL.parser.error('--resume needs the --run-dir of the run to resume')
+    if cL.args.run_dir and cL.args.max_memory is not None:
+        cL.parser.error('--run-dir cannot be combined with --max-memory')
+    if cL.args.max_memory is not None:
+        # A text guide file is parsed whole into memory; --max-memory needs the stores of parse_crispr.py -s or -b
+        textChroms = [chrom.rstrip(',') for chrom in chromList if isTextGuideFile(guideFileName(chrom.rstrip(','), guideDir)) 
+                      and os.path.exists(guideFileName(chrom.rstrip(','), guideDir))]
+        if textChroms:
+            cL.parser.error('--max-memory needs guide stores (parse_crispr.py -s or -b); only text guide files for ' + ', '.join(textChroms))
+    if cL.args.format in ('parquet', 'arrow'):
+        try:
+            requireArrow()
+        except ImportError as err:
+            cL.parser.error(str(err))
+    output = GuideOutput(cL.outputPrefix(), settings, cL.args.format, cL.args.long) if not batch else None
+    checkpoints = RunCheckpoints(cL.args.run_dir, cL.args.resume) if cL.args.run_dir else None
     
-        guidesInFivePrimeRange, guidesInThreePrimeRange, guidesInMidRange = newGuides.rangeLists()
+    cache = ResultCache(cL.args.cache, cL.args.cache_size) if cL.args.cache else None
+    try:
+        annotation = AnnotationTable(cL.args.annotation) if cL.args.annotation else None
+    except OSError as err:
+        cL.parser.error(str(err))
     
-        nearestFivePrime, greenFivePrime, yellowFivePrime, nearestThreePrime, greenThreePrime, yellowThreePrime = newGuides.spliceSiteGuides(guidesInFivePrimeRange, guidesInThreePrimeRange)
+    if batch:
+        batchMain(cL, cache, metrics, settings, guideDir, checkpoints, annotation)
+        if cache is not None:
+            cache.close()
+    elif cL.args.max_memory is not None:
+        streamMain(cL, output, cache, metrics, settings, guideDir, annotation)
+        if cache is not None:
+            cache.close()
+    else:
+        exonFile = ExonFile(cL)
+        with metrics.stage('all', 'exon file read') as record, output.openExonMap() as exonMap:
+            # Each exon once, however many input lines name it
+            allExons = exonFile.parseFile(exonMap)
+            record['candidates'] = len(allExons)
+        reportSkippedLines(exonFile, output)
         
-        midExonGuides = newGuides.midExonGuides(guidesInMidRange)
+        # Selections of every exon, ALL chromosomes included, for the coverage table
+        selections = {}
+        # Chromosomes with input exons; the others have no rows to join
+        designed = {exon.split(',', 1)[0] + ',' for exon in allExons}
         
-        # Combine each indiv chromosome list into a master list for each category
-        for item in nearestFivePrime:
-            allnearestFivePrime.append(item)
-        for item in greenFivePrime:
-            allgreenFivePrime.append(item)
-        for item in yellowFivePrime:
-            allyellowFivePrime.append(item)
-        
-        for item in nearestThreePrime:
-            allnearestThreePrime.append(item)
-        for item in greenThreePrime:
-            allgreenThreePrime.append(item)
-        for item in yellowThreePrime:
-            allyellowThreePrime.append(item)
-        
-        for item in midExonGuides:
-            allMidExon.append(item)
-    
-    header = "chromosome,exonStart,exonEnd,nearestGuide,nearestMIT,nearestDoench,greenGuide,greenMIT,greenDoench,yellowGuide,yellowMIT,yellowDoench"
-    gap3 = ['-','-','-']
-    gap6 = ['-','-','-','-','-','-']
-    
-    #########################
-    # Write Five Prime File #
-    #########################
-    
-    with open('allnearestFivePrime.csv', 'a') as f:
-        for item in allnearestFivePrime:
-            item = ','.join(map(str, item[1:]))
-            f.writelines(item + '\n')
-        f.close()
-    
-    with open('allnearestFivePrime.csv', 'r') as infile:
-        with open('nearestAndgreenFivePrime.csv', 'a') as outfile:
-            for item in allgreenFivePrime:
-                written = False 
-                for line in infile:
-                    if int(line.split(',')[1]) == int(item[2]):
-                        newline = line.rstrip('\n') + ',' + ','.join(map(str, item[4:]))
-                        outfile.writelines(newline + '\n')
-                        written = True 
-                        break
-                # if no previous entry exists for this exon, create one
-                if written == False :
-                    item = ','.join(map(str, item[1:]))
-                    item = item.split(',')[:3] + gap3 + item.split(',')[3:]
-                    outfile.writelines(','.join(map(str, item)) + '\n')
-            outfile.close()
-        infile.close()
-                        
-    with open('nearestAndgreenFivePrime.csv', 'r') as infile:
-        with open(cL.args.filename.split('.')[0] + '_5PrimeGuideRNAs.csv', 'a') as outfile:
-            outfile.writelines(header + "\n")
-            for item in allyellowFivePrime:
-                written = False
-                for line in infile:
-                    if int(line.split(',')[1]) == int(item[2]):
-                        newline = line.rstrip('\n') + ',' + ','.join(map(str, item[4:]))
-                        outfile.writelines(newline + '\n')
-                        written = True
-                        break
-                if written == False : 
-                    item = ','.join(map(str, item[1:]))
-                    item = item.split(',')[:3] + gap6 + item.split(',')[3:]
-                    outfile.writelines(','.join(map(str, item)) + '\n')
-            outfile.close()
-        infile.close()
-    
-    os.remove('allnearestFivePrime.csv')
-    os.remove('nearestAndgreenFivePrime.csv')
-    
-    ##########################
-    # Write Three Prime File #
-    ##########################
-    
-    with open('allnearestThreePrime.csv', 'a') as f:
-        for item in allnearestFivePrime:
-            item = ','.join(map(str, item[1:]))
-            f.writelines(item + '\n')
-        f.close()
-    
-    with open('allnearestThreePrime.csv', 'r') as infile:
-        with open('nearestAndgreenThreePrime.csv', 'a') as outfile:
-            for item in allgreenThreePrime:
-                written = False
-                for line in infile:
-                    if int(line.split(',')[1]) == int(item[2]):
-                        newline = line.rstrip('\n') + ',' + ','.join(map(str, item[4:]))
-                        outfile.writelines(newline + '\n')
-                        written = True 
-                        break
-                # if no previous entry exists for this exon, create one
-                if written == False :
-                    item = ','.join(map(str, item[1:]))
-                    item = item.split(',')[:3] + gap3 + item.split(',')[3:]
-                    outfile.writelines(','.join(map(str, item)) + '\n')
-            outfile.close()
-        infile.close()
-                        
-    with open('nearestAndgreenThreePrime.csv', 'r') as infile:
-        with open(cL.args.filename.split('.')[0] + '_3PrimeGuideRNAs.csv', 'a') as outfile:
-            outfile.writelines(header + "\n")
-            for item in allyellowThreePrime:
-                written = False
-                for line in infile:
-                    if int(line.split(',')[1]) == int(item[2]):
-                        newline = line.rstrip('\n') + ',' + ','.join(map(str, item[4:]))
-                        outfile.writelines(newline + '\n')
-                        written = True
-                        break
-                if written == False : 
-                    item = ','.join(map(str, item[1:]))
-                    item = item.split(',')[:3] + gap6 + item.split(',')[3:]
-                    outfile.writelines(','.join(map(str, item)) + '\n')
-            outfile.close()
-        infile.close()
-    
-    os.remove('allnearestThreePrime.csv')
-    os.remove('nearestAndgreenThreePrime.csv')
-    
-    #######################
-    # Write Mid Exon File #
-    #######################
-    
-    with open (cL.args.filename.split('.')[0] + '_MidExonGuideRNAs.csv', 'a') as m:
-        m.writelines("chromosome,exonStart,exonEnd,midExonGuide,MIT,Doench")
-        for item in allMidExon:
-            item = ','.join(map(str, item[1:]))
-            m.writelines(item + '\n')
-        m.close()
-        
-        
-    print("Finished designing guide RNAs for the given exons.")
-    print("5' splice site, 3' splice site, and mid-exon gRNAs can be found in the following files:")
-    print(cL.args.filename.split('.')[0] + '_5PrimeGuideRNAs.csv')
-    print(cL.args.filename.split('.')[0] + '_3PrimeGuideRNAs.csv')
-    print(cL.args.filename.split('.')[0] + '_MidExonGuideRNAs.csv')
-    #######################
-    # Write Skipped Exons #
-    #######################
-    
-    with open(cL.args.filename, 'r') as f:
-        exons = [part for part in [entry.strip().replace(':','-') for entry in f.readlines()[1:]]]
-        exonstart = [part for part in [entry.split('-')[1] for entry in exons]]
-    
-    # Exons with no 5' guides
-    missed_exons_five = []
-    with open(cL.args.filename.split('.')[0] + '_5PrimeGuideRNAs.csv', 'r') as five:
-        guides = [part for part in [entry.strip().split(',')[1] for entry in five.readlines()[1:]]]
-        for exon in exonstart:
-            if exon not in guides:
-                missed_exons_five.append(exon)
-                
-    print("No 5' splice site guide RNAs were found for the following exons:")
-    for miss in missed_exons_five:
-        for exon in exons:
-            if miss in exon:
-                print(exon)
-                
-    # Exons with no 3' guides
-    missed_exons_three = []
-    with open (cL.args.filename.split('.')[0] + '_3PrimeGuideRNAs.csv', 'r') as three:
-        guides = [part for part in [entry.strip().split(',')[1] for entry in three.readlines()[1:]]]
-        for exon in exonstart:
-            if exon not in guides:
-                missed_exons_three.append(exon)
+        with output:
+            for chrom, chromosomeGuides in zip(chromList, designChromosomes(allExons, chromList, cL.args.jobs, cache, metrics, settings, guideDir=guideDir, checkpoints=checkpoints, prefetch=cL.args.prefetch, annotation=annotation)):
+                if chrom not in designed:
+                    continue
                 
-    print("No 3' splice site guide RNAs were found for the following exons:")
-    for miss in missed_exons_three:
-        for exon in exons:
-            if miss in exon:
-                print(exon)
+                # Append each indiv chromosome's rows to the files for each position
+                with metrics.stage(chrom.rstrip(','), 'output join') as record:
+                    record['guides'] = sum(map(len, chromosomeGuides))
+                    record['candidates'] = output.writeGuides(chromosomeGuides)
+                selections.update(exonSelections(chromosomeGuides))
                 
-    # Exons with no mid-exon guides
-    missed_exons_mid = []
-    with open (cL.args.filename.split('.')[0] + '_MidExonGuideRNAs.csv', 'r') as m:
-        guides = [part for part in [entry.strip().split(',')[1] for entry in m.readlines()[1:]]]
-        for exon in exonstart:
-            if exon not in guides:
-                missed_exons_mid.append(exon)
-                
-    print("No mid-exon guide RNAs were found for the following exons:")
-    for miss in missed_exons_mid:
-        for exon in exons:
-            if miss in exon:
-                print(exon)
-    f.close()
-    five.close()
-    three.close()
-    m.close()
+        if cache is not None:
+            cache.close()
+            
+        print("Finished designing guide RNAs for the given exons.")
+        print("5' splice site, 3' splice site, and mid-exon gRNAs can be found in the following files:")
+        for guideFile in output.guideFiles():
+            print(guideFile)
+        #######################
+        # Write Skipped Exons #
+        #######################
+        
+        with metrics.stage('all', 'missing-exon report') as record:
+            missed = output.writeCoverage(fileExonKeys(allExons), selections)
+            record['candidates'] = sum(map(len, missed))
+        print("Per-exon coverage of each position and score tier is in", output.coverageFile)
+        reportMissingExons(missed)
+            
+    if annotation is not None:
+        annotation.close()
+    metrics.finish()
+    if cL.args.metrics:
+        metrics.write(cL.args.metrics)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(cL.args.profile)
     
 if __name__ == "__main__":
     main();
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+########################################################################
+# File: guide_candidates.py
+# Purpose: Compact candidate lists for guideRNAselection.py.
+#          A candidate is a (guide, exon) pair found by GuideRna.rangeLists.
+#          Instead of one 7-tuple per candidate, repeating the chromosome,
+#          exon coordinates, sequence and scores, a list stores two integer
+#          columns: the guide's row in the chromosome's GuideTable and the
+#          exon's position in the list of exons on the chromosome.
+#          Full guide tuples are only built for the selected guides.
+########################################################################
+
+from array import array
+
+
+class GuideCandidates :
+    '''
+    (guide, exon) pairs for one guide RNA location on one chromosome.
+
+    attributes:
+    guides : the GuideTable the guide ids index; must stay open while records are read.
+    exons : the (chromosome, exonStart, exonEnd) keys the exon ids index.
+    guideIds, exonIds : int64 / int32 arrays, one entry per candidate.
+
+    methods:
+    append(guideId, exonId) : adds a candidate.
+    record(i) : returns candidate i as a (cutsite, chromosome, exonStart, exonEnd, guideSeq, MIT, Doench) tuple.
+    records() : returns every candidate as a tuple, in order.
+    '''
+
+    __slots__ = ('guides', 'exons', 'guideIds', 'exonIds')
+
+    def __init__(self, guides, exons):
+        self.guides = guides
+        self.exons = exons
+        self.guideIds = array('q')
+        self.exonIds = array('i')
+
+    def __len__(self):
+        return len(self.guideIds)
+
+    def append(self, guideId, exonId):
+        self.guideIds.append(guideId)
+        self.exonIds.append(exonId)
+
+    def record(self, i):
+        guideId = self.guideIds[i]
+        chromosome, exonStart, exonEnd = self.exons[self.exonIds[i]]
+        return (self.guides.cutsites[guideId], chromosome, exonStart, exonEnd,
+                self.guides.sequence(guideId), self.guides.mit[guideId], self.guides.doench[guideId])
+
+    def records(self):
+        return [self.record(i) for i in range(len(self))]
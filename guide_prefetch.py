@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+########################################################################
+# File: guide_prefetch.py
+# Purpose: Background loading of guide tables for guideRNAselection.py.
+#          While one chromosome is being selected, a loader thread reads
+#          the guide tables of the next chromosomes into a bounded queue,
+#          so reading overlaps with the selection of the current chromosome.
+#          It is on by default only for guide stores (chrN.guides or
+#          chrN.blocks): a chrN,crispr.txt file is parsed while holding the
+#          interpreter lock, so loading it in a thread overlaps nothing.
+#
+#  Stage metrics: 'guide prefetch' is the time the loader thread spent
+#  reading a table, 'guide wait' the time the design loop then blocked
+#  waiting for it. The difference is the load time hidden by the overlap.
+#  The loader thread collects its records apart and they are added to the
+#  run's metrics (and shown as progress) by get(), in the design loop, so
+#  only one thread writes progress lines.
+########################################################################
+
+import queue
+import threading
+
+from run_metrics import RunMetrics
+
+
+class GuidePrefetcher :
+    '''
+    Loads guide tables in a background thread, at most depth chromosomes ahead of the consumer.
+    A table is only loaded once a slot is free, so at most depth + 1 tables (depth loaded ahead 
+    and the one in use) are held at a time.
+    load(chrom) returns (GuideTable, window indexes) for a chromosome (see prefetchChromosome).
+
+    methods:
+    get() : returns the next (chrom, GuideTable, window indexes), in the order given; raises the loader's error for that chromosome.
+    close() : stops the loader thread and closes tables that were loaded but not taken.
+    '''
+
+    def __init__(self, chroms, load, depth=1, metrics=None):
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        # The queue is bounded by the slots: one is taken before each load and given back by get()
+        self.slots = threading.Semaphore(max(1, depth))
+        self.loaded = queue.Queue()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(list(chroms), load), name='guide-prefetch', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, chroms, load):
+        '''Loader thread: load(chrom) each chromosome in turn and queue (chrom, table, indexes, error, metric records).'''
+        for chrom in chroms:
+            while not self.slots.acquire(timeout=0.1):
+                if self.stopping.is_set():
+                    return
+            if self.stopping.is_set():
+                return
+            metrics = RunMetrics()
+            try:
+                with metrics.stage(chrom.rstrip(','), 'guide prefetch') as record:
+                    table, indexes = load(chrom)
+                    record['guides'] = len(table)
+                item = (chrom, table, indexes, None, metrics.records)
+            except Exception as err:
+                item = (chrom, None, None, err, metrics.records)
+
+            self.loaded.put(item)
+            if item[3] is not None:
+                return
+
+    def get(self):
+        with self.metrics.stage('', 'guide wait') as record:
+            chrom, table, indexes, err, records = self.loaded.get()
+            self.slots.release()
+            record['chromosome'] = chrom.rstrip(',')
+            record['guides'] = len(table) if table is not None else None
+        self.metrics.extend(records)
+        if err is not None:
+            raise err
+        return chrom, table, indexes
+
+    def close(self):
+        self.stopping.set()
+        while self.thread.is_alive() or not self.loaded.empty():
+            try:
+                chrom, table, indexes, err, records = self.loaded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if table is not None:
+                table.close()
+        self.thread.join()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+########################################################################
+# File: guide_store.py
+# Purpose: Per-chromosome guide RNA tables for guideRNAselection.py.
+#          Guides are loaded either from the comma-separated chrN,crispr.txt
+#          files written by parse_crispr.py, or from a columnar binary
+#          store (chrN.guides) that is memory-mapped instead of parsed.
+#
+#  Binary store layout (native byte order, sections padded to 8 bytes):
+#          header  : magic, version, byte order, guide count, sequence bytes
+#          int32   : cut sites, sorted ascending
+#          uint8   : MIT scores
+#          uint8   : Doench scores
+#          uint64  : offsets into the sequence block (count + 1 entries)
+#          bytes   : concatenated guide sequences
+#
+#  Block store layout (chrN.blocks, native byte order): guides sorted by cut
+#  site are cut into blocks of a few thousand guides, each zlib-compressed,
+#  with a coordinate index in front so a reader only seeks to and
+#  decompresses the blocks overlapping the regions it needs.
+#          header  : magic, version, byte order, guide count, block count
+#          index   : per block first and last cut site, file offset,
+#                    compressed size and guide count
+#          blocks  : per block int32 cut sites, uint8 MIT, uint8 Doench,
+#                    uint32 sequence offsets (count + 1), sequences
+########################################################################
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+
+STORE_MAGIC = b'GRNA'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('=4sIB7xQQ')
+
+BLOCK_STORE_MAGIC = b'GRNB'
+BLOCK_STORE_VERSION = 1
+BLOCK_INDEX_ENTRY = struct.Struct('=iiQII')
+
+
+def textFileName(chrom, directory='.'):
+    '''Returns the path of the comma-separated guide file for a chromosome, e.g. chr1,crispr.txt'''
+    return os.path.join(directory, chrom + ',' + 'crispr.txt')
+
+
+def storeFileName(chrom, directory='.'):
+    '''Returns the path of the binary guide store for a chromosome, e.g. chr1.guides'''
+    return os.path.join(directory, chrom + '.guides')
+
+
+def blockStoreFileName(chrom, directory='.'):
+    '''Returns the path of the block-compressed guide store for a chromosome, e.g. chr1.blocks'''
+    return os.path.join(directory, chrom + '.blocks')
+
+
+def cutSite(directionality, guideStart):
+    '''Returns the cut site of a guide given its strand and start, or None for an unknown strand.'''
+    if directionality == '-' :
+        return guideStart + 2
+    elif directionality == '+' :
+        return guideStart + 16
+    return None
+
+
+def parseGuideLine(crisprLine):
+    '''
+    Parses one line of a chrN,crispr.txt file.
+    Returns (cutsite, guideSeq, MITscore, DoenchScore) with integer scores, or None if the strand is unknown.
+    '''
+    fields = crisprLine.strip().split(',')
+    cutsite = cutSite(fields[3], int(fields[1]))
+    if cutsite is None:
+        return None
+    MITscore = int(fields[5])
+    DoenchScore = int(fields[6].split(' ')[0].replace('%',''))
+    return cutsite, fields[4], MITscore, DoenchScore
+
+
+def _padding(position):
+    return -position % 8
+
+
+class GuideTable :
+    '''
+    All guides on one chromosome, sorted by cut site.
+
+    attributes:
+    cutsites, mit, doench : indexable sequences of ints, one entry per guide.
+
+    methods:
+    sequence(i) : returns the guide sequence of guide i.
+    nbytes() : returns the size of the table's columns and sequences in bytes.
+    prefetch() : asks the kernel to read a memory-mapped store ahead of use.
+    fromText(path) : builds a table by parsing a chrN,crispr.txt file.
+    fromStore(path) : memory-maps a binary store written by writeStore().
+    fromBlocks(path, regions) : reads the blocks of a block store overlapping the given regions.
+    '''
+
+    def __init__(self, cutsites, mit, doench, offsets, sequences, mapping=None):
+        self.cutsites = cutsites
+        self.mit = mit
+        self.doench = doench
+        self.offsets = offsets
+        self.sequences = sequences
+        self.mapping = mapping
+
+    def __len__(self):
+        return len(self.cutsites)
+
+    def sequence(self, i):
+        return str(self.sequences[self.offsets[i]:self.offsets[i+1]], 'ascii')
+
+    def nbytes(self):
+        '''Returns the bytes held by the columns and sequences (for a memory-mapped store, the mapped part of the file).'''
+        return sum(memoryview(column).nbytes for column in (self.cutsites, self.mit, self.doench, self.offsets, self.sequences))
+
+    def prefetch(self):
+        '''Starts reading a store-backed table into the page cache in the background (no-op for in-memory tables).'''
+        if self.mapping is not None and hasattr(mmap, 'MADV_WILLNEED'):
+            self.mapping.madvise(mmap.MADV_WILLNEED)
+
+    def close(self):
+        '''Releases the memory map of a store-backed table.'''
+        if self.mapping is not None:
+            for view in (self.cutsites, self.mit, self.doench, self.offsets, self.sequences):
+                view.release()
+            self.mapping.close()
+            self.mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def fromRecords(cls, records):
+        '''Builds an in-memory table from (cutsite, guideSeq, MITscore, DoenchScore) tuples.'''
+        records = sorted(records, key=lambda record: record[0])
+        cutsites = array('i', (record[0] for record in records))
+        mit = array('B', (min(max(record[2], 0), 255) for record in records))
+        doench = array('B', (min(max(record[3], 0), 255) for record in records))
+        offsets = array('Q', [0])
+        sequences = bytearray()
+        for record in records:
+            sequences += record[1].encode('ascii')
+            offsets.append(len(sequences))
+        return cls(cutsites, mit, doench, offsets, bytes(sequences))
+
+    @classmethod
+    def fromText(cls, path):
+        '''Parses a comma-separated chrN,crispr.txt file.'''
+        with open(path, 'r') as h:
+            return cls.fromRecords(record for record in map(parseGuideLine, h) if record is not None)
+
+    @classmethod
+    def fromStore(cls, path):
+        '''Memory-maps a binary store. No guide data is copied; columns are views into the map.'''
+        with open(path, 'rb') as h:
+            size = os.fstat(h.fileno()).st_size
+            if size < STORE_HEADER.size:
+                raise ValueError(path + ' is not a guide store')
+            mapping = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, littleEndian, count, seqLength = STORE_HEADER.unpack_from(mapping, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            mapping.close()
+            raise ValueError(path + ' is not a version {} guide store'.format(STORE_VERSION))
+        if bool(littleEndian) != (sys.byteorder == 'little'):
+            mapping.close()
+            raise ValueError(path + ' was written on a machine with a different byte order')
+
+        view = memoryview(mapping)
+        position = STORE_HEADER.size
+        columns = []
+        for typecode, length in (('i', count), ('B', count), ('B', count), ('Q', count + 1)):
+            position += _padding(position)
+            nbytes = length * array(typecode).itemsize
+            columns.append(view[position:position + nbytes].cast(typecode))
+            position += nbytes
+        sequences = view[position:position + seqLength]
+        view.release()
+
+        return cls(*columns, sequences, mapping=mapping)
+
+    @classmethod
+    def fromBlocks(cls, path, regions=None):
+        '''
+        Reads a block store written by writeBlockStore().
+        regions is a list of sorted, disjoint [low, high) cut site ranges; only the blocks 
+        overlapping them are read and decompressed, so the table holds those guides (and the 
+        other guides sharing their blocks). With regions None every block is read.
+        '''
+        cutsites = array('i')
+        mit = array('B')
+        doench = array('B')
+        offsets = array('Q', [0])
+        sequences = bytearray()
+
+        with open(path, 'rb') as h:
+            header = h.read(STORE_HEADER.size)
+            if len(header) < STORE_HEADER.size:
+                raise ValueError(path + ' is not a guide block store')
+            magic, version, littleEndian, count, blockCount = STORE_HEADER.unpack(header)
+            if magic != BLOCK_STORE_MAGIC or version != BLOCK_STORE_VERSION:
+                raise ValueError(path + ' is not a version {} guide block store'.format(BLOCK_STORE_VERSION))
+            if bool(littleEndian) != (sys.byteorder == 'little'):
+                raise ValueError(path + ' was written on a machine with a different byte order')
+
+            index = list(BLOCK_INDEX_ENTRY.iter_unpack(h.read(blockCount * BLOCK_INDEX_ENTRY.size)))
+            if regions is None:
+                blocks = range(blockCount)
+            else:
+                lastCutsites = [entry[1] for entry in index]
+                blocks = []
+                for low, high in regions:
+                    block = bisect_left(lastCutsites, low)
+                    while block < blockCount and index[block][0] < high:
+                        if not blocks or blocks[-1] < block:
+                            blocks.append(block)
+                        block += 1
+
+            for block in blocks:
+                firstCutsite, lastCutsite, offset, length, blockGuides = index[block]
+                h.seek(offset)
+                data = memoryview(zlib.decompress(h.read(length)))
+                position = 0
+                blockColumns = []
+                for typecode, columnLength in (('i', blockGuides), ('B', blockGuides), ('B', blockGuides), ('I', blockGuides + 1)):
+                    column = array(typecode)
+                    nbytes = columnLength * column.itemsize
+                    column.frombytes(data[position:position + nbytes])
+                    blockColumns.append(column)
+                    position += nbytes
+                blockCutsites, blockMIT, blockDoench, blockOffsets = blockColumns
+
+                cutsites.extend(blockCutsites)
+                mit.extend(blockMIT)
+                doench.extend(blockDoench)
+                base = len(sequences)
+                offsets.extend(base + blockOffset for blockOffset in blockOffsets[1:])
+                sequences += data[position:]
+
+        return cls(cutsites, mit, doench, offsets, bytes(sequences))
+
+
+def writeStore(path, table):
+    '''
+    Writes a GuideTable to path in the binary store layout.
+    The file is written under a temporary name and renamed into place.
+    '''
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as out:
+        out.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, sys.byteorder == 'little', len(table), len(table.sequences)))
+        position = STORE_HEADER.size
+        for column in (table.cutsites, table.mit, table.doench, table.offsets):
+            out.write(b'\0' * _padding(position))
+            position += _padding(position)
+            data = memoryview(column).cast('B')
+            out.write(data)
+            position += len(data)
+        out.write(table.sequences)
+    os.replace(tmpPath, path)
+
+
+def writeBlockStore(path, table, blockGuides=4096):
+    '''
+    Writes a GuideTable to path in the block store layout, blockGuides guides per block.
+    The file is written under a temporary name and renamed into place.
+    '''
+    blockGuides = max(1, blockGuides)
+    blocks = []
+    for first in range(0, len(table), blockGuides):
+        last = min(first + blockGuides, len(table))
+        start = table.offsets[first]
+        blockOffsets = array('I', (table.offsets[i] - start for i in range(first, last + 1)))
+        data = b''.join((memoryview(table.cutsites)[first:last].tobytes(), memoryview(table.mit)[first:last].tobytes(),
+                         memoryview(table.doench)[first:last].tobytes(), blockOffsets.tobytes(),
+                         bytes(table.sequences[start:table.offsets[last]])))
+        blocks.append((table.cutsites[first], table.cutsites[last - 1], last - first, zlib.compress(data, 6)))
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as out:
+        out.write(STORE_HEADER.pack(BLOCK_STORE_MAGIC, BLOCK_STORE_VERSION, sys.byteorder == 'little', len(table), len(blocks)))
+        offset = STORE_HEADER.size + len(blocks) * BLOCK_INDEX_ENTRY.size
+        for firstCutsite, lastCutsite, count, data in blocks:
+            out.write(BLOCK_INDEX_ENTRY.pack(firstCutsite, lastCutsite, offset, len(data), count))
+            offset += len(data)
+        for firstCutsite, lastCutsite, count, data in blocks:
+            out.write(data)
+    os.replace(tmpPath, path)
+
+
+def isCurrentStore(path, textPath):
+    '''Returns True when the store at path exists and is not older than the text file it is built from (if that is still there).'''
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(textPath) or os.path.getmtime(path) >= os.path.getmtime(textPath)
+
+
+def guideFileName(chrom, directory='.'):
+    '''
+    Returns the path loadGuideTable reads for chrom: the binary store if present, 
+    otherwise the block store if present, otherwise the text file.
+    A store older than the text file (re-split since the store was written) is skipped.
+    '''
+    textPath = textFileName(chrom, directory)
+    for path in (storeFileName(chrom, directory), blockStoreFileName(chrom, directory)):
+        if isCurrentStore(path, textPath):
+            return path
+    return textPath
+
+
+def isTextGuideFile(path):
+    '''Returns True when path (from guideFileName) is a chrN,crispr.txt text file rather than a store.'''
+    return not path.endswith(('.guides', '.blocks'))
+
+
+def loadGuideTable(chrom, directory='.', regions=None):
+    '''
+    Returns the GuideTable for chrom (e.g. 'chr1').
+    The binary store is memory-mapped when present. Otherwise, from a block store only the 
+    blocks overlapping regions (sorted, disjoint [low, high) cut site ranges; None for all) 
+    are read, and as a last resort the text file is parsed.
+    '''
+    path = guideFileName(chrom, directory)
+    if path.endswith('.guides'):
+        return GuideTable.fromStore(path)
+    if path.endswith('.blocks'):
+        return GuideTable.fromBlocks(path, regions)
+    return GuideTable.fromText(path)
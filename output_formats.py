@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+########################################################################
+# File: output_formats.py
+# Purpose: Table writers for the output files of guideRNAselection.py.
+#
+#  Every writer takes rows in batches (one call per chromosome or chunk)
+#  and appends them to its file, so output is written as results arrive.
+#  Formats:
+#     csv      plain CSV; missing guides are written as '-'
+#     csv.gz   gzip compressed CSV
+#     parquet  Parquet file, one row group per batch (needs pyarrow)
+#     arrow    Arrow IPC file, one record batch per batch (needs pyarrow)
+#  Parquet and Arrow columns are typed: coordinates are int64, MIT and
+#  Doench scores and 0/1 coverage flags uint8, and missing guides are nulls.
+########################################################################
+
+import csv
+import gzip
+
+FORMATS = ('csv', 'csv.gz', 'parquet', 'arrow')
+
+# Column types of the output tables
+STRING, COORDINATE, SCORE, FLAG = 'string', 'coordinate', 'score', 'flag'
+
+
+def requireArrow():
+    '''Returns the pyarrow module, or raises ImportError naming the formats that need it.'''
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('the parquet and arrow output formats need pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+class CsvTableWriter :
+    '''
+    Writes a CSV table, plain or gzip compressed.
+
+    methods:
+    writeRows(rows) : appends a batch of rows; None values are written as '-', and values holding commas or quotes are quoted.
+    close() : closes the file.
+    '''
+
+    gap = '-'
+
+    def __init__(self, path, columns, compress=False):
+        self.outfile = gzip.open(path, 'wt', compresslevel=6, newline='') if compress else open(path, 'w', newline='')
+        self.writer = csv.writer(self.outfile, lineterminator='\n')
+        self.writer.writerow(name for name, columnType in columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeRows(self, rows):
+        self.writer.writerows([self.gap if value is None else value for value in row] for row in rows)
+
+    def close(self):
+        self.outfile.close()
+
+
+class ArrowTableWriter :
+    '''
+    Writes a Parquet or Arrow IPC table with typed columns (see the column types above).
+
+    methods:
+    writeRows(rows) : appends a batch of rows as a row group / record batch; None values are written as nulls.
+    close() : closes the file.
+    '''
+
+    def __init__(self, path, columns, parquet=True):
+        pa = requireArrow()
+        types = {STRING: pa.string(), COORDINATE: pa.int64(), SCORE: pa.uint8(), FLAG: pa.uint8()}
+        self.schema = pa.schema([(name, types[columnType]) for name, columnType in columns])
+        if parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeRows(self, rows):
+        if rows:
+            pa = requireArrow()
+            columns = zip(*rows)
+            self.writer.write_batch(pa.record_batch([pa.array(column, field.type) for column, field in zip(columns, self.schema)], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def fileExtension(outputFormat):
+    return '.' + outputFormat
+
+
+def openTable(path, columns, outputFormat='csv'):
+    '''
+    Returns a writer for a table with columns, a list of (name, column type) pairs, in outputFormat.
+    path should end with fileExtension(outputFormat).
+    '''
+    if outputFormat in ('csv', 'csv.gz'):
+        return CsvTableWriter(path, columns, outputFormat == 'csv.gz')
+    if outputFormat in ('parquet', 'arrow'):
+        return ArrowTableWriter(path, columns, outputFormat == 'parquet')
+    raise ValueError('unknown output format ' + outputFormat)
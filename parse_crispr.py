@@ -17,8 +17,35 @@
 import sys 
 import argparse
 import csv
+import gzip
+import io
+import os
+import time
+from datetime import date
+from collections import OrderedDict
 from argparse import RawTextHelpFormatter 
 
+from assembly_store import DEFAULT_STORE_ROOT, AssemblyStore
+from guide_store import GuideTable, blockStoreFileName, storeFileName, textFileName, writeBlockStore, writeStore
+
+# Columns of the raw crispr.bed kept in each chromosome file (cut -f 1,2,3,6,12,14,15,16): 
+# chrom, start, end, strand, guide sequence, MIT score, Doench score and the next column
+RAW_BED_COLUMNS = (0, 1, 2, 5, 11, 13, 14, 15)
+# Guides whose bed line contains one of these are dropped
+SKIPPED_GUIDES = ('MIT Spec. Score: -1', 'Sequence is not unique in genome')
+
+def openBed(path=None):
+    '''
+    Opens a bed file (standard input when path is None) for reading text lines.
+    gzip and bgzip compressed input is recognised by its magic number and decompressed while streaming.
+    '''
+    binary = open(path, 'rb') if path is not None else sys.stdin.buffer
+    if not hasattr(binary, 'peek'):
+        binary = io.BufferedReader(binary)
+    if binary.peek(2)[:2] == b'\x1f\x8b':
+        binary = gzip.GzipFile(fileobj=binary, mode='rb')
+    return io.TextIOWrapper(binary, encoding='ascii', errors='replace', newline='')
+
 class CommandLine() :
     '''Implements a help option with program information.'''
     def __init__(self) :
@@ -31,46 +58,216 @@ class CommandLine() :
                                                             "$ wget http://hgdownload.cse.ucsc.edu/admin/exe/linux.x86_64/bigBedToBed \n"
                                                             "$ chmod +x bigBedToBed \n"
                                                             "$ ./bigBedToBed crispr.bb crispr.bed\n"
-                                                            "$ sed '/MIT Spec. Score: -1/d' ./crispr.bed | sed '/Sequence is not unique in genome/d' | cut -f 1,2,3,6,12,14,15,16 > crispr_parsed.bed \n"
                                                             " \n"
-                                                            "Then execute this script on crispr_parsed.bed (runtime ~ 3 hrs) \n",
+                                                            "Then execute this script on crispr.bed (runtime ~ minutes). The file may be gzip or bgzip compressed.\n"
+                                                            "Guides with MIT Spec. Score -1 or a sequence that is not unique in the genome are dropped,\n"
+                                                            "and columns 1,2,3,6,12,14,15,16 are kept, in one pass over the file.\n"
+                                                            " \n"
+                                                            "Files already filtered with\n"
+                                                            "$ sed '/MIT Spec. Score: -1/d' ./crispr.bed | sed '/Sequence is not unique in genome/d' | cut -f 1,2,3,6,12,14,15,16 > crispr_parsed.bed \n"
+                                                            "are accepted as well.\n",
                                               formatter_class=RawTextHelpFormatter,
                                               add_help = True, 
-                                              usage = 'crisprParse.py <crispr_parsed.bed'
+                                              usage = 'parse_crispr.py crispr.bed.gz'
                                                 )
+        
+        self.parser.add_argument('infile', nargs='?', help='crispr.bed from bigBedToBed, plain or gzip/bgzip compressed (default: standard input)')
+        self.parser.add_argument('--max-open-files', action='store', type=int, default=64, help='Maximum number of chromosome files held open at once (default 64)')
+        self.parser.add_argument('--batch-lines', action='store', type=int, default=10000, help='Lines buffered per chromosome before each write (default 10000)')
+        self.parser.add_argument('-s', '--store', action='store_true', help='Also write a binary guide store (chrN.guides) per chromosome,\nwhich guideRNAselection.py memory-maps instead of parsing the text file')
+        self.parser.add_argument('-b', '--blocks', action='store_true', help='Also write a block-compressed guide store with a cut site index (chrN.blocks)\nper chromosome; guideRNAselection.py reads only the blocks overlapping its exons')
+        self.parser.add_argument('--block-guides', action='store', type=int, default=4096, help='Guides per compressed block (default 4096)')
+        self.parser.add_argument('--assembly', action='store', help='Add the guides to the versioned guide store as this assembly (e.g. hg38)\ninstead of writing them to the current directory. Only chromosomes whose\ncontent changed since the current release are rewritten')
+        self.parser.add_argument('--release', action='store', default=date.today().isoformat(), help='Track release name for --assembly (default: today\'s date)')
+        self.parser.add_argument('--store-root', action='store', default=DEFAULT_STORE_ROOT, help='Root directory of the versioned guide store (default {})'.format(DEFAULT_STORE_ROOT))
                
         self.args = self.parser.parse_args()
+
+class ChromosomeWriterPool : 
+    '''
+    Buffered writers for the per-chromosome crispr files.
+    
+    Lines are collected in memory per chromosome and written in batches. 
+    At most maxOpen files are held open; when a new chromosome needs a file
+    and the pool is full, the least recently used file is closed.
+    Each file is truncated the first time it is opened in a run and appended to 
+    after that, so reopening an evicted chromosome never loses lines.
+    
+    methods: 
+    write(chrom, line) : queue one line for a chromosome file.
+    close() : write out all buffered lines and close every file.
+    '''
+    
+    def __init__(self, maxOpen=64, batchLines=10000, maxBufferedLines=1000000, suffix='crispr.txt', directory='.'):
+        self.directory = directory
+        self.maxOpen = max(1, maxOpen)
+        self.batchLines = max(1, batchLines)
+        self.maxBufferedLines = max(self.batchLines, maxBufferedLines)
+        self.suffix = suffix
+        self.handles = OrderedDict()
+        self.buffers = {}
+        self.buffered = 0
+        self.chromosomes = set()
+        
+    def fileName(self, chrom):
+        '''Returns the file name read by GuideRna.rangeLists for a chromosome.'''
+        return os.path.join(self.directory, chrom + ',' + self.suffix)
+        
+    def handle(self, chrom):
+        '''Returns an open file for chrom, evicting the least recently used file if needed.'''
+        h = self.handles.get(chrom)
+        if h is not None:
+            self.handles.move_to_end(chrom)
+            return h
+            
+        if len(self.handles) >= self.maxOpen:
+            oldChrom, oldHandle = self.handles.popitem(last=False)
+            oldHandle.close()
+            
+        mode = 'a' if chrom in self.chromosomes else 'w'
+        self.chromosomes.add(chrom)
+        h = open(self.fileName(chrom), mode, buffering=1 << 20)
+        self.handles[chrom] = h
+        return h
+        
+    def flush(self, chrom):
+        '''Writes the buffered lines of one chromosome in a single call.'''
+        lines = self.buffers.pop(chrom, None)
+        if lines:
+            self.handle(chrom).write(''.join(lines))
+            self.buffered -= len(lines)
+            
+    def write(self, chrom, line):
+        lines = self.buffers.setdefault(chrom, [])
+        lines.append(line)
+        self.buffered += 1
+        
+        if len(lines) >= self.batchLines:
+            self.flush(chrom)
+        elif self.buffered >= self.maxBufferedLines:
+            for bufferedChrom in list(self.buffers):
+                self.flush(bufferedChrom)
+                
+    def close(self):
+        for chrom in list(self.buffers):
+            self.flush(chrom)
+        for h in self.handles.values():
+            h.close()
+        self.handles.clear()
         
 class CrisprReader : 
     '''
-    to do
+    Splits a crispr bed file (see CommandLine help) into one 
+    comma-separated file per chromosome, named e.g. chr1,crispr.txt.
+    Raw bigBedToBed lines are filtered and cut to the parsed columns on the way; 
+    lines that are already parsed (8 columns) are split as they are.
+    
+    methods: 
+    readcrispr() : reads the input once and writes every chromosome file.
+    writeStores() : converts each chromosome file into a binary guide store.
+    writeBlockStores() : converts each chromosome file into a block-compressed guide store.
+    removeStores() : removes the guide stores left from an earlier run for the chromosomes just split.
     '''
     
-    def __init__ (self, infile):
+    def __init__ (self, infile, maxOpen=64, batchLines=10000, progressEvery=1000000, progress=sys.stderr, directory='.'):
         self.infile = infile 
+        self.directory = directory
+        self.chromosomes = set()
+        self.maxOpen = maxOpen
+        self.batchLines = batchLines
+        self.progressEvery = progressEvery
+        self.progress = progress
+        self.skipped = 0
         
     def readcrispr(self):
         '''Reads input file and writes each chromosome to a different file.'''
-                        
-        for line in self.infile:
-            line = line.replace('\t',',').strip()
-            with open(line.split(',')[0] + ',' + 'crispr.txt', 'a') as h:
-                h.write(line+'\n')
-                
+        
+        writers = ChromosomeWriterPool(self.maxOpen, self.batchLines, directory=self.directory)
+        startTime = time.time()
+        lineCount = 0
+        
+        try:
+            for line in self.infile:
+                if any(phrase in line for phrase in SKIPPED_GUIDES):
+                    self.skipped += 1
+                    continue
+                    
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) > len(RAW_BED_COLUMNS):
+                    line = ','.join(fields[column] for column in RAW_BED_COLUMNS if column < len(fields)).strip()
+                else:
+                    line = line.replace('\t',',').strip()
+                if not line:
+                    continue
+                writers.write(line.split(',', 1)[0], line + '\n')
                 
-        h.close()
+                lineCount += 1
+                if self.progress is not None and lineCount % self.progressEvery == 0:
+                    elapsed = max(time.time() - startTime, 1e-9)
+                    print('Parsed {:,} lines ({:,.0f} lines/sec)'.format(lineCount, lineCount / elapsed), file=self.progress, flush=True)
+        finally:
+            writers.close()
+        self.chromosomes = writers.chromosomes
         
-        return 'Done parsing CRISPR guide RNA file'
+        return 'Done parsing CRISPR guide RNA file ({:,} guides dropped as not unique or without an MIT score)'.format(self.skipped)
+        
+    def writeStores(self):
+        '''Writes chrN.guides for every chromosome file written by readcrispr, one chromosome at a time.'''
+        
+        for chrom in sorted(self.chromosomes):
+            writeStore(storeFileName(chrom, self.directory), GuideTable.fromText(textFileName(chrom, self.directory)))
+            
+        return 'Done writing binary guide stores'
+        
+    def removeStores(self, store=False, blocks=False):
+        '''
+        Removes the chrN.guides (unless store) and chrN.blocks (unless blocks) of every chromosome file 
+        written by readcrispr, so an older store is not read in place of the new text file or of a 
+        newly written store of the other kind. Returns the names of the removed files.
+        '''
+        removed = []
+        for chrom in sorted(self.chromosomes):
+            for path, keep in ((storeFileName(chrom, self.directory), store), (blockStoreFileName(chrom, self.directory), blocks)):
+                if not keep and os.path.exists(path):
+                    os.remove(path)
+                    removed.append(os.path.basename(path))
+        return removed
+        
+    def writeBlockStores(self, blockGuides=4096):
+        '''Writes chrN.blocks for every chromosome file written by readcrispr, one chromosome at a time.'''
+        
+        for chrom in sorted(self.chromosomes):
+            writeBlockStore(blockStoreFileName(chrom, self.directory), GuideTable.fromText(textFileName(chrom, self.directory)), blockGuides)
+            
+        return 'Done writing block-compressed guide stores'
                 
 def main(cL=None):
-    '''Reads in a file from standard input. Calls the readcrispr function.'''
+    '''Reads in a bed file, or standard input. Calls the readcrispr function.'''
     cL = CommandLine ()
     
-    crisprFiles = CrisprReader(sys.stdin)        
-
-    makeFiles = crisprFiles.readcrispr()
+    if cL.args.assembly:
+        assemblies = AssemblyStore(cL.args.store_root)
+        stagingDir = assemblies.stagingDir(cL.args.assembly, cL.args.release)
+        with openBed(cL.args.infile) as infile:
+            print(CrisprReader(infile, cL.args.max_open_files, cL.args.batch_lines, directory=stagingDir).readcrispr())
+        changed, unchanged = assemblies.update(cL.args.assembly, cL.args.release, stagingDir, cL.args.store, cL.args.blocks, cL.args.block_guides)
+        print('{} release {}: {} chromosomes rewritten, {} unchanged'.format(cL.args.assembly, cL.args.release, len(changed), len(unchanged)))
+        print(assemblies.releaseDir(cL.args.assembly, cL.args.release))
+        return
+    
+    with openBed(cL.args.infile) as infile:
+        crisprFiles = CrisprReader(infile, cL.args.max_open_files, cL.args.batch_lines)        
+        makeFiles = crisprFiles.readcrispr()
     print(makeFiles)
     
+    removed = crisprFiles.removeStores(cL.args.store, cL.args.blocks)
+    if removed:
+        print('Removed {} guide stores left from an earlier run ({})'.format(len(removed), ', '.join(removed)))
+    if cL.args.store:
+        print(crisprFiles.writeStores())
+    if cL.args.blocks:
+        print(crisprFiles.writeBlockStores(cL.args.block_guides))
+    
 if __name__ == "__main__":
     main();
     raise SystemExit
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+########################################################################
+# File: result_cache.py
+# Purpose: On-disk cache of per-exon guide RNA selections for guideRNAselection.py.
+#
+#  Each entry maps (chromosome, exonStart, exonEnd, selection settings,
+#  guide file checksum) to the guides selected for that exon: by default
+#  nearest, green and yellow 5' guides, nearest, green and yellow 3' guides,
+#  and the mid-exon guide. Entries for a changed guide file or changed settings
+#  are simply never hit again and age out through LRU eviction.
+########################################################################
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def fileChecksum(path, blockSize=1 << 20):
+    '''Returns the SHA-256 hex digest of a file's contents.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as h:
+        for block in iter(lambda: h.read(blockSize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache :
+    '''
+    SQLite-backed, size-bounded cache of per-exon selections.
+
+    methods:
+    guideFingerprint(path) : returns the checksum of a guide file, rehashing only when its size or mtime changed.
+    lookup(exonKeys, settings, fingerprint) : returns the cached selections for the given exons.
+    store(selections, settings, fingerprint) : adds selections, then trims the cache.
+    trim() : evicts the least recently used entries beyond maxEntries.
+    '''
+
+    def __init__(self, path, maxEntries=1000000):
+        self.maxEntries = maxEntries
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS selections (
+                chromosome TEXT NOT NULL,
+                exonStart INTEGER NOT NULL,
+                exonEnd INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                guides TEXT NOT NULL,
+                selection TEXT NOT NULL,
+                lastUsed REAL NOT NULL,
+                PRIMARY KEY (chromosome, exonStart, exonEnd, settings, guides)
+            );
+            CREATE INDEX IF NOT EXISTS selectionsLastUsed ON selections (lastUsed);
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                checksum TEXT NOT NULL
+            );
+        ''')
+
+    def close(self):
+        self.trim()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def guideFingerprint(self, path):
+        '''Returns the checksum of a guide file. Checksums are remembered by path, size and mtime.'''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute('SELECT size, mtime, checksum FROM fingerprints WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        checksum = fileChecksum(path)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, checksum))
+        return checksum
+
+    def lookup(self, exonKeys, settings, fingerprint):
+        '''
+        Returns a dict mapping each cached (chromosome, exonStart, exonEnd) in exonKeys to its
+        selection (one guide tuple per selection list, or None where no guide was found).
+        '''
+        found = {}
+        for key in set(exonKeys):
+            row = self.db.execute('SELECT selection FROM selections WHERE chromosome = ? AND exonStart = ? AND exonEnd = ? AND settings = ? AND guides = ?',
+                                  key + (settings, fingerprint)).fetchone()
+            if row is not None:
+                found[key] = [tuple(guide) if guide is not None else None for guide in json.loads(row[0])]
+
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany('UPDATE selections SET lastUsed = ? WHERE chromosome = ? AND exonStart = ? AND exonEnd = ? AND settings = ? AND guides = ?',
+                                    [(now,) + key + (settings, fingerprint) for key in found])
+        return found
+
+    def store(self, selections, settings, fingerprint):
+        '''Stores a dict of exon key -> selection, then trims the cache to maxEntries.'''
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO selections VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [key + (settings, fingerprint, json.dumps(selection), now) for key, selection in selections.items()])
+        self.trim()
+
+    def trim(self):
+        '''Evicts the least recently used entries beyond maxEntries.'''
+        with self.db:
+            excess = self.db.execute('SELECT COUNT(*) FROM selections').fetchone()[0] - self.maxEntries
+            if excess > 0:
+                self.db.execute('DELETE FROM selections WHERE rowid IN (SELECT rowid FROM selections ORDER BY lastUsed LIMIT ?)', (excess,))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+########################################################################
+# File: run_checkpoint.py
+# Purpose: Per-chromosome checkpoints for resumable guideRNAselection.py runs.
+#
+#  Every finished chromosome's selections are written to <run dir>/chrN.json
+#  under a temporary name and renamed into place, so a checkpoint is either
+#  complete or absent. Each checkpoint carries a key made from the
+#  chromosome's exons, the selection settings and the guide file (path,
+#  size and mtime); --resume only reuses checkpoints whose key matches.
+########################################################################
+
+import hashlib
+import json
+import os
+
+
+class RunCheckpoints :
+    '''
+    Checkpoints of finished chromosomes in a run directory.
+
+    methods:
+    key(exonKeys, settings, guidePath) : returns the key identifying a chromosome's inputs.
+    load(chrom, key) : returns the saved selections of chrom, or None if there is no checkpoint for key.
+    save(chrom, key, selections) : atomically writes the selections of chrom.
+    '''
+
+    def __init__(self, directory, resume=False):
+        self.directory = directory
+        self.resume = resume
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(exonKeys, settings, guidePath):
+        '''exonKeys are (chromosome, exonStart, exonEnd) tuples, settings a DesignSettings key string.'''
+        stat = os.stat(guidePath)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([settings, os.path.abspath(guidePath), stat.st_size, stat.st_mtime_ns]).encode('utf-8'))
+        for exon in sorted(set(exonKeys)):
+            digest.update('{},{},{}\n'.format(*exon).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, chrom):
+        return os.path.join(self.directory, chrom + '.json')
+
+    def load(self, chrom, key):
+        '''Returns a dict mapping exon keys to selections, as saved by save(), or None.'''
+        if not self.resume:
+            return None
+        try:
+            with open(self.path(chrom)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get('key') != key:
+            return None
+        return {(chromosome, exonStart, exonEnd): [tuple(guide) if guide is not None else None for guide in selection]
+                for chromosome, exonStart, exonEnd, selection in checkpoint['selections']}
+
+    def save(self, chrom, key, selections):
+        path = self.path(chrom)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'key': key, 'selections': [list(exon) + [selection] for exon, selection in selections.items()]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+########################################################################
+# File: run_metrics.py
+# Purpose: Stage-level instrumentation for guideRNAselection.py.
+#          Each stage of a run records its wall time, the number of guides
+#          it scanned, the number of candidates it kept and the peak RSS of
+#          the process, per chromosome. Records can be shown as a live
+#          progress line and written as a JSON or CSV metrics file.
+########################################################################
+
+import csv
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+METRIC_FIELDS = ['chromosome', 'stage', 'seconds', 'guides', 'candidates', 'peakRssMB']
+
+
+def peakRssMB():
+    '''Returns the peak resident set size of this process so far, in MB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+class RunMetrics :
+    '''
+    Collects one record per (chromosome, stage).
+
+    methods:
+    stage(chromosome, name) : context manager timing a stage; yields the record so counts can be filled in.
+    extend(records) : adds records collected elsewhere, e.g. in a worker process.
+    finish() : ends the live progress line.
+    write(path) : writes all records as JSON, or as CSV if path ends in .csv.
+    '''
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.records = []
+
+    @contextmanager
+    def stage(self, chromosome, name):
+        record = {'chromosome': chromosome, 'stage': name, 'seconds': 0.0, 'guides': None, 'candidates': None, 'peakRssMB': None}
+        startTime = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - startTime
+            record['peakRssMB'] = round(peakRssMB(), 1)
+            self.extend([record])
+
+    def extend(self, records):
+        self.records.extend(records)
+        if self.progress is not None:
+            for record in records:
+                self.showProgress(record)
+
+    def showProgress(self, record):
+        '''Prints one record as a progress line; the line is overwritten in place on a terminal.'''
+        line = '{:<8} {:<22} {:8.2f} s'.format(record['chromosome'], record['stage'], record['seconds'])
+        if record['guides'] is not None:
+            line += '  guides {:,}'.format(record['guides'])
+        if record['candidates'] is not None:
+            line += '  candidates {:,}'.format(record['candidates'])
+        line += '  peak RSS {:,.0f} MB'.format(record['peakRssMB'])
+        if self.progress.isatty():
+            print('\r\033[K' + line, end='', file=self.progress, flush=True)
+        else:
+            print(line, file=self.progress, flush=True)
+
+    def finish(self):
+        '''Ends an in-place progress line.'''
+        if self.progress is not None and self.progress.isatty():
+            print(file=self.progress, flush=True)
+
+    def write(self, path):
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=METRIC_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.records, f, indent=1)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+########################################################################
+# File: test_batch_prefix.py
+# Purpose: Output file prefixes of guideRNAselection.py -f and --batch.
+#
+#  Run from the repository root:  python3 -m unittest discover tests
+########################################################################
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from guideRNAselection import CommandLine
+
+
+class BatchPrefixTest(unittest.TestCase) :
+    '''Prefixes are cut at the extension only, and colliding prefixes are an error.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        os.mkdir('sub')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def touch(*paths):
+        for path in paths:
+            open(path, 'w').close()
+
+    @staticmethod
+    def commandLine(*args):
+        with mock.patch.object(sys, 'argv', ['guideRNAselection.py'] + list(args)):
+            return CommandLine()
+
+    def testDotDirectoryGlob(self):
+        self.touch('sub/a.txt', 'sub/b.txt')
+        prefixes = self.commandLine('--batch', './sub/*.txt').batchPrefixes()
+        self.assertEqual(prefixes, {'./sub/a.txt': './sub/a', './sub/b.txt': './sub/b'})
+
+    def testMultiDotNames(self):
+        self.touch('sub/a.v1.txt', 'sub/a.v2.txt')
+        prefixes = self.commandLine('--batch', 'sub/*.txt').batchPrefixes()
+        self.assertEqual(prefixes, {'sub/a.v1.txt': 'sub/a.v1', 'sub/a.v2.txt': 'sub/a.v2'})
+
+    def testCollidingPrefixes(self):
+        self.touch('sub/a.txt', 'sub/a.csv')
+        cL = self.commandLine('--batch', 'sub/a.*')
+        with mock.patch.object(sys, 'stderr'), self.assertRaises(SystemExit):
+            cL.batchPrefixes()
+
+    def testOutputPrefix(self):
+        self.assertEqual(self.commandLine('-f', './sub/a.v1.txt').outputPrefix(), './sub/a.v1')
+
+
+if __name__ == '__main__':
+    unittest.main()
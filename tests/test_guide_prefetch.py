@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+########################################################################
+# File: test_guide_prefetch.py
+# Purpose: Bounded loading ahead of guide_prefetch.GuidePrefetcher.
+#
+#  Run from the repository root:  python3 -m unittest discover tests
+########################################################################
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from guide_prefetch import GuidePrefetcher
+
+
+class CountedTable :
+    '''Stands in for a GuideTable and counts the tables that are loaded and not yet closed.'''
+
+    lock = threading.Lock()
+    open = 0
+    peak = 0
+
+    def __init__(self):
+        with self.lock:
+            CountedTable.open += 1
+            CountedTable.peak = max(CountedTable.peak, CountedTable.open)
+
+    def __len__(self):
+        return 0
+
+    def close(self):
+        with self.lock:
+            CountedTable.open -= 1
+
+
+class GuidePrefetcherTest(unittest.TestCase) :
+    '''At most depth tables are loaded ahead of the one in use.'''
+
+    def setUp(self):
+        CountedTable.open = CountedTable.peak = 0
+
+    def testResidentTables(self):
+        chroms = ['chr{},'.format(i) for i in range(1, 7)]
+        for depth in (1, 2):
+            CountedTable.open = CountedTable.peak = 0
+            with GuidePrefetcher(chroms, lambda chrom: (CountedTable(), None), depth) as prefetcher:
+                for chrom in chroms:
+                    taken, table, indexes = prefetcher.get()
+                    self.assertEqual(taken, chrom)
+                    # Give the loader time to fill every free slot while this table is in use
+                    time.sleep(0.05)
+                    table.close()
+            self.assertEqual(CountedTable.peak, depth + 1)
+            self.assertEqual(CountedTable.open, 0)
+
+    def testCloseEarly(self):
+        with GuidePrefetcher(['chr1,', 'chr2,', 'chr3,'], lambda chrom: (CountedTable(), None), 2) as prefetcher:
+            taken, table, indexes = prefetcher.get()
+            table.close()
+        self.assertEqual(CountedTable.open, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
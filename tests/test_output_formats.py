@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+########################################################################
+# File: test_output_formats.py
+# Purpose: CSV writers of output_formats.py.
+#
+#  Run from the repository root:  python3 -m unittest discover tests
+########################################################################
+
+import csv
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from output_formats import COORDINATE, STRING, openTable
+
+
+class CsvTableWriterTest(unittest.TestCase) :
+    '''Every row reads back with as many fields as the header, whatever its text holds.'''
+
+    columns = [('line', COORDINATE), ('input', STRING), ('chromosome', STRING), ('exonStart', COORDINATE), ('exonEnd', COORDINATE)]
+    rows = [(1, 'chr1,10054,10401', 'chr1', 10054, 10401),
+            (2, 'bogus "x", y', None, None, None)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def roundTrip(self, outputFormat, opener):
+        path = os.path.join(self.tmpdir.name, 'map.' + outputFormat)
+        with openTable(path, self.columns, outputFormat) as table:
+            table.writeRows(self.rows)
+        with opener(path, 'rt', newline='') as f:
+            return list(csv.reader(f))
+
+    def testQuotedFields(self):
+        for outputFormat, opener in (('csv', open), ('csv.gz', gzip.open)):
+            rows = self.roundTrip(outputFormat, opener)
+            self.assertEqual(rows[0], [name for name, columnType in self.columns])
+            self.assertEqual(rows[1], ['1', 'chr1,10054,10401', 'chr1', '10054', '10401'])
+            self.assertEqual(rows[2], ['2', 'bogus "x", y', '-', '-', '-'])
+
+
+if __name__ == '__main__':
+    unittest.main()